@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+from rdflib import URIRef, Literal, RDF
+
+import training
+from compiled_graph import GraphBuilder, file_hash
+from preprocess import ntriple
+from spreading_activation import Spreader, DEFAULT_CFG
+
+SIZES = [1000, 4000]  # Number of movies, movielens 1M has 3883
+SEED_SIZES = [1, 10, 50, 200]  # Number of initially activated movies, users of movielens 1M rate 20 to 2314
+REPEATS = 20
+K = 20
+
+# Credits per movie as (predicate, object type, uri prefix, size of the pool, zipf exponent, min, max per movie).
+# Objects are drawn with popularity falling off by rank, so a few people and most genres, languages and countries
+# become hubs.
+CREDITS = [
+    ('https://schema.org/Actor', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 1.0, 8, 60),
+    ('https://schema.org/Director', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 0.9, 1, 2),
+    ('https://schema.org/Writer', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 0.9, 1, 4),
+    ('https://schema.org/Producer', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 0.9, 1, 8),
+    ('https://schema.org/Editor', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 0.9, 1, 1),
+    ('https://schema.org/Composer', 'https://schema.org/Person', 'https://www.imdb.com/name/nm', 6.0, 0.9, 1, 1),
+    ('https://schema.org/Genre', 'https://schema.org/Genre', 'https://www.imdb.com/genre/g', 18, 0.8, 1, 3),
+    ('https://schema.org/inLanguage', 'https://schema.org/Language', 'https://www.imdb.com/langs/l', 30, 1.6, 1, 2),
+    ('https://schema.org/countryOfOrigin', 'https://schema.org/Country', 'https://www.imdb.com/countries/c',
+     50, 1.4, 1, 2),
+]  # Pool sizes given as float are per movie, so the number of people grows with the graph
+DECADES = [1920, 1930, 1940, 1950, 1960, 1970, 1980, 1990, 2000]
+DECADE_SHARES = [0.01, 0.03, 0.04, 0.04, 0.06, 0.08, 0.16, 0.55, 0.03]  # Movielens 1M is mostly 1990s movies
+
+
+def zipf_sampler(n, exponent, rng):
+    """
+    :return: function drawing a number of distinct indices from 0..n-1, with probability of i proportional to
+             1 / (i + 1) ** exponent
+    """
+    cumulative = np.cumsum(1 / np.arange(1, n + 1) ** exponent)
+    cumulative /= cumulative[-1]
+    return lambda size: np.unique(np.searchsorted(cumulative, rng.random(size)))
+
+
+def synthetic_triples(n_movies, seed=0):
+    """
+    Generates a movie graph shaped like the one preprocess.py creates from movielens and IMDB, without fetching anything
+    :param n_movies: number of movies, their movielens OIDs are 1..n_movies
+    :param seed: seed of the random generator, the same seed gives the same graph
+    :return: generator of triples
+    """
+    rng = np.random.default_rng(seed)
+    samplers = [
+        zipf_sampler(int(pool * n_movies) if isinstance(pool, float) else pool, exponent, rng)
+        for _, _, _, pool, exponent, _, _ in CREDITS
+    ]
+    named = set()
+    for oid in range(1, n_movies + 1):
+        movie = URIRef(f'https://www.imdb.com/title/tt{oid:07d}')
+        decade = int(rng.choice(DECADES, p=DECADE_SHARES))
+        yield movie, RDF.type, URIRef('https://schema.org/Movie')
+        yield movie, URIRef('https://schema.org/Name'), Literal(f'Movie {oid}')
+        yield movie, URIRef('https://schema.org/datePublished'), Literal(decade + int(rng.integers(10)))
+        yield movie, URIRef('https://example.org/ml-OID'), Literal(oid)
+        credits = [(URIRef('https://example.org/fromDecade'), 'https://example.org/Decade',
+                    f'https://www.imdb.com/decades/{decade}', decade)]
+        for (pred, obj_type, prefix, _, _, low, high), sample in zip(CREDITS, samplers):
+            for i in sample(int(rng.integers(low, high + 1))):
+                credits.append((URIRef(pred), obj_type, f'{prefix}{i}', f'{obj_type.split("/")[-1]} {i}'))
+        for pred, obj_type, uri, name in credits:
+            if uri not in named:
+                named.add(uri)
+                yield URIRef(uri), RDF.type, URIRef(obj_type)
+                yield URIRef(uri), URIRef('https://schema.org/Name'), Literal(name)
+            yield movie, pred, URIRef(uri)
+
+
+def write_graph(n_movies, directory, seed=0):
+    """
+    Writes a synthetic graph as a TTL file and a spreader snapshot, unless they already exist
+    :return: TTL file, snapshot file
+    """
+    ttl_file = os.path.join(directory, f'synthetic-{n_movies}-{seed}.ttl')
+    snapshot_file = os.path.join(directory, f'synthetic-{n_movies}-{seed}.snapshot')
+    if not os.path.isfile(ttl_file):
+        builder = GraphBuilder()
+        with open(f'{ttl_file}.tmp', 'w', encoding='utf-8') as f:
+            for triple in synthetic_triples(n_movies, seed):
+                f.write(ntriple(triple))
+                builder.add(*triple)
+        os.replace(f'{ttl_file}.tmp', ttl_file)
+        builder.build().save(snapshot_file, source_hash=file_hash(ttl_file))
+    return ttl_file, snapshot_file
+
+
+def synthetic_ratings(n_movies, n_users, rng):
+    """
+    :return: DataFrame with UID, OID and rating columns of n_users users with 20 to 200 validation ratings each
+    """
+    rows = []
+    for uid in range(1, n_users + 1):
+        oids = rng.choice(np.arange(1, n_movies + 1), size=min(int(rng.integers(20, 201)), n_movies), replace=False)
+        rows.extend((uid, int(oid), int(rng.integers(1, 6))) for oid in oids)
+    return pd.DataFrame(rows, columns=['UID', 'OID', 'rating'])
+
+
+def stats(seconds):
+    seconds = np.array(seconds)
+    return {
+        'median': float(np.median(seconds)),
+        'mean': float(seconds.mean()),
+        'min': float(seconds.min()),
+        'p95': float(np.percentile(seconds, 95)),
+        'n': len(seconds),
+    }
+
+
+def run(sizes=SIZES, seed_sizes=SEED_SIZES, repeats=REPEATS, spread_steps=2, directory=None, ttl_load=True, seed=0):
+    """
+    Times the hot paths of spreading activation on synthetic graphs
+    :param sizes: numbers of movies of the graphs
+    :param seed_sizes: numbers of initially activated movies
+    :param repeats: how many random seed sets to time per seed size
+    :param spread_steps: how many steps of spreading activation to perform
+    :param directory: where the synthetic graphs are kept, a temporary directory if None
+    :param ttl_load: also time parsing the TTL file, which takes long for big graphs
+    :param seed: seed of the graphs and seed sets
+    :return: list of result dicts with the benchmark name, its parameters and timing stats in seconds
+    """
+    results = []
+
+    def record(name, n_movies, seconds, **params):
+        results.append({'name': name, 'n_movies': n_movies, **params, 'seconds': stats(seconds)})
+        print(f'{name:<22} movies={n_movies:<7} {params} median={results[-1]["seconds"]["median"] * 1000:.3f}ms')
+
+    with tempfile.TemporaryDirectory() as tmp_directory:
+        for n_movies in sizes:
+            ttl_file, snapshot_file = write_graph(n_movies, directory or tmp_directory, seed)
+            rng = np.random.default_rng(seed)
+            if ttl_load:
+                time_started = timer()
+                Spreader(ttl_file=ttl_file)
+                record('load_ttl', n_movies, [timer() - time_started])
+            load_seconds = []
+            for _ in range(max(repeats // 4, 1)):
+                time_started = timer()
+                spreader = Spreader.from_snapshot(snapshot_file, ttl_file)
+                load_seconds.append(timer() - time_started)
+            record('load_snapshot', n_movies, load_seconds, nodes=spreader.compiled.n_nodes,
+                   edges=spreader.compiled.n_edges)
+            spreader.update_cfg(DEFAULT_CFG)
+
+            for n_seeds in seed_sizes:
+                lookup, top_k, spread = [], [], []
+                steps = [[] for _ in range(spread_steps)]
+                step_nodes = [[] for _ in range(spread_steps)]
+                for _ in range(repeats):
+                    seeds = rng.choice(np.arange(1, n_movies + 1), size=min(n_seeds, n_movies), replace=False)
+                    time_started = timer()
+                    nodes = spreader.ml_initial_activation(seeds, reset=True)
+                    lookup.append(timer() - time_started)
+                    already_spread = np.zeros(spreader.compiled.n_nodes, dtype=bool)
+                    already_spread[nodes] = True
+                    spreader.initial_nodes = np.array(nodes, dtype=np.int32)
+                    for step in range(spread_steps):
+                        step_nodes[step].append(len(nodes))
+                        time_started = timer()
+                        nodes = spreader.spread_step(nodes, already_spread)
+                        steps[step].append(timer() - time_started)
+                    time_started = timer()
+                    spreader.get_top_k(K)
+                    top_k.append(timer() - time_started)
+                    time_started = timer()
+                    spreader.spread(seeds, spread_steps)
+                    spread.append(timer() - time_started)
+                record('ml_initial_activation', n_movies, lookup, seeds=n_seeds)
+                for step in range(spread_steps):
+                    record('spread_step', n_movies, steps[step], seeds=n_seeds, step=step + 1,
+                           nodes_spread=float(np.mean(step_nodes[step])))
+                record('get_top_k', n_movies, top_k, seeds=n_seeds, k=K)
+                record('spread', n_movies, spread, seeds=n_seeds, steps=spread_steps)
+
+            val = synthetic_ratings(n_movies, repeats, rng)
+            ndcg_seconds = []
+            for uid in range(1, repeats + 1):
+                recs = rng.choice(np.arange(1, n_movies + 1), size=K, replace=False)
+                time_started = timer()
+                training.ndcg(val, uid, recs, top_k=K)
+                ndcg_seconds.append(timer() - time_started)
+            record('training.ndcg', n_movies, ndcg_seconds, k=K, ratings=len(val))
+    return results
+
+
+def environment():
+    """
+    :return: dict with the commit and the versions the benchmark ran with
+    """
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], capture_output=True, text=True, check=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+    }
+
+
+def result_key(result):
+    measured = ('seconds', 'nodes', 'edges', 'nodes_spread', 'ratings')  # Not parameters of the benchmark
+    return tuple((key, value) for key, value in result.items() if key not in measured)
+
+
+def compare(old_file, new_file):
+    """
+    Prints the median times of two benchmark files side by side, matched by benchmark name and parameters
+    """
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+    print(f'old: {old["environment"]["commit"]}  new: {new["environment"]["commit"]}')
+    old_results = {result_key(result): result for result in old['results']}
+    for result in new['results']:
+        key = result_key(result)
+        label = ' '.join(f'{value}' if name == 'name' else f'{name}={value}' for name, value in key)
+        new_median = result['seconds']['median']
+        if key not in old_results:
+            print(f'{label:<60} {"":>12} {new_median * 1000:>11.3f}ms')
+            continue
+        old_median = old_results[key]['seconds']['median']
+        ratio = new_median / old_median if old_median else float('inf')
+        print(f'{label:<60} {old_median * 1000:>10.3f}ms {new_median * 1000:>10.3f}ms {ratio:>7.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark spreading activation on synthetic graphs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of movies of the graphs')
+    parser.add_argument('--seed-sizes', type=int, nargs='+', default=SEED_SIZES,
+                        help='numbers of initially activated movies')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='seed sets timed per seed size')
+    parser.add_argument('--steps', type=int, default=2, help='spread steps')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the graphs and seed sets')
+    parser.add_argument('--graph-dir', default=None, help='keep the synthetic graphs here to reuse them across runs')
+    parser.add_argument('--no-ttl', action='store_true', help='skip timing the TTL parsing')
+    parser.add_argument('--out', default=None, help='json file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.graph_dir:
+        os.makedirs(args.graph_dir, exist_ok=True)
+    results = run(args.sizes, args.seed_sizes, args.repeats, args.steps, args.graph_dir, not args.no_ttl, args.seed)
+    report = {
+        'environment': environment(),
+        'params': {'sizes': args.sizes, 'seed_sizes': args.seed_sizes, 'repeats': args.repeats, 'steps': args.steps,
+                   'seed': args.seed, 'cfg': DEFAULT_CFG},
+        'results': results,
+    }
+    out = args.out or f'benchmark-{(report["environment"]["commit"] or "nocommit")[:8]}.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {out}')
+
+
+if __name__ == "__main__":
+    main()
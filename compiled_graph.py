@@ -0,0 +1,512 @@
+import hashlib
+import json
+import os
+import struct
+from array import array
+
+import numpy as np
+from rdflib import URIRef, Literal, RDF
+
+ML_OID_PREDICATE = 'https://example.org/ml-OID'
+MOVIE_TYPE = 'https://schema.org/Movie'
+ACTIVATION_PREDICATE = 'https://example.org/hasActivation'
+
+SNAPSHOT_MAGIC = b'SASNAP\x00\x00'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ALIGNMENT = 64  # Arrays start at aligned offsets so they can be viewed straight from the mmap
+
+
+class SnapshotError(Exception):
+    """Snapshot is missing, unreadable, of another version or built from a different TTL file"""
+
+
+def file_hash(filename):
+    """
+    :param filename: file to hash
+    :return: hex sha256 of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _align(size):
+    return -(-size // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def save_arrays(filename, arrays, header, magic=SNAPSHOT_MAGIC, version=SNAPSHOT_VERSION):
+    """
+    Writes named arrays and a json header into a binary file that can be memory-mapped by load_arrays().
+    The file is written next to the target first and then moved, so readers never see a partial file.
+    :param filename: file to write
+    :param arrays: dict of 1D NumPy arrays
+    :param header: json serialisable dict stored with the arrays
+    :param magic: 8 bytes identifying the kind of file
+    :param version: format version of the file
+    """
+    layout = {}
+    position = 0
+    for name, values in arrays.items():
+        layout[name] = {'dtype': values.dtype.str, 'length': len(values), 'offset': position}
+        position += _align(values.nbytes)
+    header = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    data_start = _align(len(magic) + 8 + len(header))
+
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<II', version, len(header)))
+        f.write(header)
+        for name, values in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(values).tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_filename, filename)
+
+
+def load_arrays(filename, magic=SNAPSHOT_MAGIC, version=SNAPSHOT_VERSION):
+    """
+    Memory-maps a file written by save_arrays(), the arrays are read-only views of the file
+    :param filename: file to read
+    :param magic: 8 bytes identifying the kind of file
+    :param version: expected format version of the file
+    :return: header dict, dict of arrays
+    """
+    if not os.path.isfile(filename):
+        raise SnapshotError(f'"{filename}" not found')
+    with open(filename, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise SnapshotError(f'"{filename}" is not a {magic!r} file')
+        file_version, header_length = struct.unpack('<II', f.read(8))
+        if file_version != version:
+            raise SnapshotError(f'"{filename}" has version {file_version}, expected {version}')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = _align(len(magic) + 8 + header_length)
+
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        start = data_start + spec['offset']
+        arrays[name] = buffer[start:start + spec['length'] * dtype.itemsize].view(dtype)
+    return header, arrays
+
+
+class NodeUris:
+    """
+    Read-only list of node URIs stored as one utf-8 blob, URIs are only decoded when accessed.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, uris):
+        encoded = [uri.encode('utf-8') for uri in uris]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(uri) for uri in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class MovieIndex:
+    """
+    Bidirectional index between movielens OIDs and the graph nodes of the movies, built once when the graph is loaded.
+    Nodes are node indices for a CompiledGraph or URIRefs for an rdflib graph.
+    Several movielens movies can be the same IMDB movie, so a node can have more than one OID and appear in nodes
+    once per OID.
+    """
+
+    def __init__(self, oids, nodes):
+        """
+        :param oids: list of movielens OIDs
+        :param nodes: list of the nodes of the movies in oids
+        """
+        self.oids = oids
+        self.nodes = nodes
+        self.oid_to_node = {int(oid): node for oid, node in zip(oids, nodes)}
+        self.node_to_oids = {}
+        self.node_to_positions = {}
+        for position, (oid, node) in enumerate(zip(oids, nodes)):
+            self.node_to_oids.setdefault(node, []).append(int(oid))
+            self.node_to_positions.setdefault(node, []).append(position)
+
+    @classmethod
+    def from_rdf(cls, graph):
+        """
+        :param graph: rdflib graph as created by preprocess.py
+        :return: MovieIndex of URIRefs of all nodes with an ml-OID
+        """
+        rows = list(graph.query(f'SELECT ?mov ?mloid WHERE {{ ?mov <{ML_OID_PREDICATE}> ?mloid }}'))
+        return cls([int(oid.toPython()) for _, oid in rows], [mov for mov, _ in rows])
+
+    def __len__(self):
+        return len(self.oids)
+
+    def __contains__(self, oid):
+        return int(oid) in self.oid_to_node
+
+    def node(self, oid):
+        return self.oid_to_node[int(oid)]
+
+    def oid(self, node):
+        """
+        :return: first OID of the movie, see node_to_oids for all of them
+        """
+        return self.node_to_oids[node][0]
+
+    def positions(self, oids):
+        """
+        :param oids: list of movielens OIDs, unknown OIDs are ignored
+        :return: list of positions of the movies in the index, with every OID of a movie that has more than one
+        """
+        return [position for node in self.lookup(oids)[0] for position in self.node_to_positions[node]]
+
+    def lookup(self, oids):
+        """
+        Finds the nodes of all given movies
+        :param oids: list of movielens OIDs
+        :return: list of nodes of the known OIDs in order of first appearance without duplicates, list of unknown OIDs
+        """
+        nodes = {}
+        unknown = []
+        for oid in oids:
+            node = self.oid_to_node.get(int(oid))
+            if node is None:
+                unknown.append(int(oid))
+            else:
+                nodes[node] = None
+        return list(nodes), unknown
+
+
+def triple_oids(triples):
+    """
+    :param triples: list of triples
+    :return: movielens OIDs given by the triples
+    """
+    return [int(obj.toPython()) for _, pred, obj in triples if str(pred) == ML_OID_PREDICATE]
+
+
+def triple_movies(triples):
+    """
+    :param triples: list of triples
+    :return: set of URIs of the movies given an OID by the triples
+    """
+    return {str(subj) for subj, pred, _ in triples if str(pred) == ML_OID_PREDICATE}
+
+
+def remove_movies(graph, oids, replace=()):
+    """
+    Removes movies from an rdflib graph, together with the nodes that were linked only to them.
+    A movie with more than one OID only loses the given OIDs, it is removed once it has none left.
+    :param graph: rdflib graph as created by preprocess.py
+    :param oids: movielens OIDs of the movies to remove
+    :param replace: URIs of movies whose triples are about to be added again, they are removed too,
+                    but keep their ml-OID triples for OIDs not in oids
+    :return: list of OIDs that were removed, the others were not in the graph
+    """
+    movies = MovieIndex.from_rdf(graph)
+    oids = {int(oid) for oid in oids}
+    removed = [oid for oid in oids if oid in movies]
+    replace = {URIRef(uri) for uri in replace}
+    oid_predicate = URIRef(ML_OID_PREDICATE)
+    for movie, movie_oids in movies.node_to_oids.items():
+        if movie not in replace and not oids.intersection(movie_oids):
+            continue
+        kept = [
+            (movie, oid_predicate, obj) for obj in graph.objects(movie, oid_predicate)
+            if int(obj.toPython()) not in oids
+        ]
+        if kept and movie not in replace:
+            for triple in list(graph.triples((movie, oid_predicate, None))):
+                if triple not in kept:
+                    graph.remove(triple)
+            continue
+        linked = {obj for pred, obj in graph.predicate_objects(movie) if pred != RDF.type and isinstance(obj, URIRef)}
+        linked |= set(graph.subjects(None, movie))
+        graph.remove((movie, None, None))
+        graph.remove((None, None, movie))
+        for triple in kept:
+            graph.add(triple)
+        for node in linked:
+            if node in movies.node_to_oids:
+                continue
+            has_edges = (None, None, node) in graph or any(
+                pred != RDF.type and isinstance(obj, URIRef) for pred, obj in graph.predicate_objects(node)
+            )
+            if not has_edges:
+                graph.remove((node, None, None))
+    return removed
+
+
+class GraphBuilder:
+    """
+    Collects triples one at a time and compiles them into a CompiledGraph, so a graph can be compiled
+    while it is being written without ever holding an rdflib Graph. Literal-valued triples, rdf:type and
+    activation triples are not spreading edges and are left out, movies are the nodes typed schema:Movie
+    that have an ml-OID. Triples are expected to be unique, as they are in an rdflib Graph.
+    A movie with several ml-OIDs gets a row in movie_nodes and movie_oids for each of them.
+    """
+
+    def __init__(self):
+        self.node_index = {}
+        self.node_uris = []
+        self.predicate_index = {}
+        self.predicates = []
+        self.sources = array('i')
+        self.edge_types = array('h')
+        self.targets = array('i')
+        self.movies = set()
+        self.oids = {}  # Node index to the list of OIDs of the movie
+
+    @classmethod
+    def from_compiled(cls, compiled, remove_nodes=(), remove_oids=()):
+        """
+        Starts a builder with the nodes and edges of a compiled graph, so more triples can be added to it.
+        Nodes that are left without edges and are not movies are dropped, same as if the graph was compiled again.
+        :param compiled: CompiledGraph to start from
+        :param remove_nodes: node indices to leave out together with all of their edges
+        :param remove_oids: movielens OIDs to leave out, a movie without any OIDs left is no longer a movie
+        :return: GraphBuilder
+        """
+        builder = cls()
+        from_nodes = np.repeat(np.arange(compiled.n_nodes, dtype=np.int32), np.diff(compiled.offsets))
+        to_nodes = compiled.neighbours
+        # Every edge is stored in both directions, keep each once
+        keep = from_nodes < to_nodes
+        keep[np.flatnonzero(from_nodes == to_nodes)[::2]] = True
+        removed = np.zeros(compiled.n_nodes, dtype=bool)
+        removed[list(remove_nodes)] = True
+        keep &= ~removed[from_nodes] & ~removed[to_nodes]
+
+        used = np.zeros(compiled.n_nodes, dtype=bool)
+        used[from_nodes[keep]] = True
+        used[to_nodes[keep]] = True
+        used[compiled.movie_nodes] = True
+        used &= ~removed
+        old_nodes = np.flatnonzero(used)
+        new_ids = np.full(compiled.n_nodes, -1, dtype=np.int32)
+        new_ids[old_nodes] = np.arange(len(old_nodes), dtype=np.int32)
+
+        builder.node_uris = [compiled.node_uris[node] for node in old_nodes]
+        builder.node_index = {uri: node for node, uri in enumerate(builder.node_uris)}
+        builder.predicates = list(compiled.predicates)
+        builder.predicate_index = {pred: i for i, pred in enumerate(builder.predicates)}
+        builder.sources.frombytes(new_ids[from_nodes[keep]].astype(np.int32).tobytes())
+        builder.edge_types.frombytes(compiled.edge_types[keep].astype(np.int16).tobytes())
+        builder.targets.frombytes(new_ids[to_nodes[keep]].astype(np.int32).tobytes())
+        remove_oids = set(remove_oids)
+        for node, oid in zip(compiled.movie_nodes.tolist(), compiled.movie_oids.tolist()):
+            if used[node] and oid not in remove_oids:
+                builder.movies.add(int(new_ids[node]))
+                builder.oids.setdefault(int(new_ids[node]), []).append(oid)
+        return builder
+
+    def node_id(self, term):
+        uri = str(term)
+        if uri not in self.node_index:
+            self.node_index[uri] = len(self.node_uris)
+            self.node_uris.append(uri)
+        return self.node_index[uri]
+
+    def add(self, subj, pred, obj):
+        pred_uri = str(pred)
+        if pred_uri == ML_OID_PREDICATE:
+            self.oids.setdefault(self.node_id(subj), []).append(int(obj.toPython()))
+        elif pred == RDF.type:
+            if str(obj) == MOVIE_TYPE:
+                self.movies.add(self.node_id(subj))
+        elif pred_uri != ACTIVATION_PREDICATE and not isinstance(obj, Literal):
+            if pred_uri not in self.predicate_index:
+                self.predicate_index[pred_uri] = len(self.predicates)
+                self.predicates.append(pred_uri)
+            self.sources.append(self.node_id(subj))
+            self.edge_types.append(self.predicate_index[pred_uri])
+            self.targets.append(self.node_id(obj))
+
+    def build(self):
+        """
+        :return: CompiledGraph of all added triples
+        """
+        movies = [(node, oid) for node in sorted(self.movies) for oid in sorted(self.oids.get(node, ()))]
+        return CompiledGraph.from_edges(
+            self.node_uris, self.predicates, self.sources, self.edge_types, self.targets,
+            [node for node, _ in movies], [oid for _, oid in movies],
+        )
+
+
+class CompiledGraph:
+    """
+    Integer-indexed, in-memory form of the movie graph used for spreading activation.
+    Nodes are numbered 0..n_nodes-1 and the edges are kept as a predicate-typed CSR adjacency:
+    the edges of node i are neighbours[offsets[i]:offsets[i + 1]] with predicates edge_types[...].
+    Every RDF edge is stored in both directions, same as the UNION in the SPARQL spreading query.
+    """
+
+    def __init__(self, node_uris, predicates, offsets, neighbours, edge_types, movie_nodes, movie_oids):
+        """
+        :param node_uris: list of node URIs, position in the list is the node index
+        :param predicates: list of predicate URIs, position in the list is the edge type
+        :param offsets: int64 array of length n_nodes + 1 with the start of each node's edges
+        :param neighbours: int32 array with the node on the other end of each edge
+        :param edge_types: int16 array with the predicate index of each edge
+        :param movie_nodes: int32 array of the node indices of all movies, once per OID of the movie
+        :param movie_oids: int64 array of the movielens OIDs of movie_nodes
+        """
+        self.node_uris = node_uris
+        self.predicates = predicates
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.edge_types = edge_types
+        self.movie_nodes = movie_nodes
+        self.movie_oids = movie_oids
+        self.movies = MovieIndex(movie_oids.tolist(), movie_nodes.tolist())
+        self.source_hash = None
+
+    @property
+    def n_nodes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_edges(self):
+        return len(self.neighbours)
+
+    @classmethod
+    def from_edges(cls, node_uris, predicates, sources, edge_types, targets, movie_nodes, movie_oids):
+        """
+        Builds the CSR adjacency from a list of directed edges
+        :param node_uris: list of node URIs, position in the list is the node index
+        :param predicates: list of predicate URIs, position in the list is the edge type
+        :param sources: node indices of edge subjects
+        :param edge_types: predicate indices of the edges
+        :param targets: node indices of edge objects
+        :param movie_nodes: node indices of all movies
+        :param movie_oids: movielens OIDs of movie_nodes
+        :return: CompiledGraph
+        """
+        sources = np.asarray(sources, dtype=np.int32)
+        targets = np.asarray(targets, dtype=np.int32)
+        edge_types = np.asarray(edge_types, dtype=np.int16)
+        # Store every edge in both directions, sorted by the node they are spread from
+        from_nodes = np.concatenate([sources, targets])
+        to_nodes = np.concatenate([targets, sources])
+        types = np.concatenate([edge_types, edge_types])
+        order = np.argsort(from_nodes, kind='stable')
+        offsets = np.zeros(len(node_uris) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(from_nodes, minlength=len(node_uris)), out=offsets[1:])
+        return cls(
+            node_uris, predicates, offsets, to_nodes[order], types[order],
+            np.asarray(movie_nodes, dtype=np.int32), np.asarray(movie_oids, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_rdf(cls, graph):
+        """
+        Compiles a parsed rdflib graph. Literal-valued triples, rdf:type and activation triples are not
+        spreading edges and are left out, movies are the nodes typed schema:Movie that have an ml-OID.
+        :param graph: rdflib graph as created by preprocess.py
+        :return: CompiledGraph
+        """
+        builder = GraphBuilder()
+        for triple in graph:
+            builder.add(*triple)
+        return builder.build()
+
+    def apply_delta(self, add_triples=(), remove_oids=()):
+        """
+        Compiles the graph with movies added and removed, without going through the TTL file.
+        The result is the same graph as compiling the TTL file with the delta applied, up to the node numbering.
+        A movie with more than one OID is only removed once all of its OIDs are.
+        :param add_triples: triples of the movies to add, as created by preprocess.stream_triples()
+        :param remove_oids: movielens OIDs of movies to remove, movies that are added again are replaced
+        :return: new CompiledGraph
+        """
+        add_triples = list(add_triples)
+        dropped = {int(oid) for oid in remove_oids} | set(triple_oids(add_triples))
+        added_movies = triple_movies(add_triples)
+        remove_nodes, kept = [], []
+        for node, oids in self.movies.node_to_oids.items():
+            uri = self.node_uris[node]
+            if uri in added_movies:  # Added again, the OIDs it keeps are given to the new node
+                remove_nodes.append(node)
+                kept.extend((uri, oid) for oid in oids if oid not in dropped)
+            elif dropped.issuperset(oids):
+                remove_nodes.append(node)
+        builder = GraphBuilder.from_compiled(self, remove_nodes, dropped)
+        for triple in add_triples:
+            builder.add(*triple)
+        for uri, oid in kept:
+            builder.add(URIRef(uri), URIRef(ML_OID_PREDICATE), Literal(oid))
+        return builder.build()
+
+    def save(self, filename, source_hash=None):
+        """
+        Writes the graph into a binary snapshot that can be memory-mapped by load()
+        :param filename: snapshot file
+        :param source_hash: hash of the TTL file the graph was built from, used to detect stale snapshots
+        """
+        node_uris = self.node_uris if isinstance(self.node_uris, NodeUris) else NodeUris.from_list(self.node_uris)
+        save_arrays(filename, {
+            'node_uri_data': node_uris.data,
+            'node_uri_offsets': node_uris.offsets,
+            'offsets': self.offsets,
+            'neighbours': self.neighbours,
+            'edge_types': self.edge_types,
+            'movie_nodes': self.movie_nodes,
+            'movie_oids': self.movie_oids,
+        }, {
+            'source_hash': source_hash,
+            'predicates': list(self.predicates),
+        })
+
+    @classmethod
+    def load(cls, filename, source_hash=None):
+        """
+        Memory-maps a snapshot written by save(). Arrays are read-only views of the file, so processes loading
+        the same snapshot share its pages.
+        :param filename: snapshot file
+        :param source_hash: if given, the snapshot must have been built from a TTL file with this hash
+        :return: CompiledGraph
+        """
+        header, arrays = load_arrays(filename)
+        if source_hash is not None and header['source_hash'] != source_hash:
+            raise SnapshotError(f'snapshot "{filename}" was built from a different TTL file')
+        graph = cls(
+            NodeUris(arrays['node_uri_data'], arrays['node_uri_offsets']), header['predicates'],
+            arrays['offsets'], arrays['neighbours'], arrays['edge_types'],
+            arrays['movie_nodes'], arrays['movie_oids'],
+        )
+        graph.source_hash = header['source_hash']
+        return graph
+
+    def node_uri(self, node):
+        return URIRef(self.node_uris[node])
+
+    def edge_indices(self, nodes):
+        """
+        :param nodes: node indices
+        :return: indices of all edges of the nodes, the edges of each node in a row
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.offsets[nodes]
+        lengths = self.offsets[nodes + 1] - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def edges(self, node):
+        """
+        :param node: node index
+        :return: (neighbour indices, edge type indices) of all edges of the node
+        """
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.neighbours[start:end], self.edge_types[start:end]
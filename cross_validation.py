@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import re
+from functools import lru_cache
+from timeit import default_timer as timer
+
+import numpy as np
+import mlflow
+from hyperopt import fmin, tpe
+
+from compiled_graph import file_hash
+from evaluation import UserRatings, evaluate_users, read_ratings, select_users, summarise, K, MIN_RATING
+from spreading_activation import Spreader, WorkerPool, worker, cfg_hash, SNAPSHOT_FILE, TTL_FILE
+from training import CFG_SPACE, log_cfg
+
+FOLD_PATTERN = re.compile(r'fold_(\d+)$')
+TRAIN_FILE_NAME = 't.csv'
+VAL_FILE_NAME = 'val.csv'
+METRICS = ['ndcg', 'precision', 'recall', 'coverage', 'seconds']
+
+
+def find_folds(root='.'):
+    """
+    :param root: directory containing the fold_N directories
+    :return: paths of the fold directories sorted by N
+    """
+    folds = []
+    for name in os.listdir(root):
+        match = FOLD_PATTERN.match(name)
+        if match and os.path.isdir(os.path.join(root, name)):
+            folds.append((int(match.group(1)), os.path.join(root, name)))
+    return [fold for _, fold in sorted(folds)]
+
+
+@lru_cache(maxsize=None)
+def load_fold(fold):
+    """
+    Reads the splits of a fold and groups them by user, only once per process
+    :param fold: fold directory
+    :return: UserRatings of the train split, UserRatings of the validation split
+    """
+    train = UserRatings(read_ratings(os.path.join(fold, TRAIN_FILE_NAME)))
+    val = UserRatings(read_ratings(os.path.join(fold, VAL_FILE_NAME)))
+    return train, val
+
+
+def evaluate_fold(cfg, fold, sample=None, seed=0, k=K, min_rating=MIN_RATING, spreader=None):
+    """
+    Evaluates a config on one fold
+    :param cfg: config dict for spreader
+    :param fold: fold directory
+    :param sample: number of random validation users to evaluate, all if None
+    :param seed: seed for the user sample
+    :param k: how many recs to get per user
+    :param min_rating: movies rated at least this are activated, and are relevant in validation
+    :param spreader: Spreader to use, the one of the worker process if None
+    :return: dict of metrics from evaluation.summarise() without the per-user results
+    """
+    spreader = spreader or worker['spreader']
+    train, val = load_fold(fold)
+    time_started = timer()
+    results = evaluate_users(spreader, cfg, train, val, select_users(val, sample, seed), k, min_rating)
+    metrics = summarise(results, len(spreader.movies), timer() - time_started)
+    del metrics['users']
+    return metrics
+
+
+class CrossValidator(WorkerPool):
+    """
+    Evaluates spreader configs on all folds, with the folds evaluated concurrently in worker processes.
+    Results are cached per fold and config, so evaluating a config again returns immediately. The cache keys include
+    hashes of the graph and the fold splits, so cached results are not reused after either of them changes.
+    """
+
+    def __init__(self, folds=None, n_workers=None, sample=None, seed=0, k=K, min_rating=MIN_RATING,
+                 cache_file=None, snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE):
+        """
+        :param folds: fold directories, all fold_N directories in the working directory if None
+        :param n_workers: number of worker processes, one per fold if None, 1 evaluates in this process
+        :param sample: number of random validation users to evaluate per fold, all if None
+        :param seed: seed for the user sample
+        :param k: how many recs to get per user
+        :param min_rating: movies rated at least this are activated, and are relevant in validation
+        :param cache_file: if given, fold results are also stored in this json lines file and reused across runs
+        """
+        self.folds = folds if folds is not None else find_folds()
+        super().__init__(n_workers or len(self.folds), snapshot_file, ttl_file)
+        self.sample = sample
+        self.seed = seed
+        self.k = k
+        self.min_rating = min_rating
+        self.cache_file = cache_file
+        self.spreader = None
+        self.graph_hash = file_hash(ttl_file)  # Same as the source_hash of an up to date snapshot
+        self.fold_hashes = {
+            fold: file_hash(os.path.join(fold, TRAIN_FILE_NAME)) + file_hash(os.path.join(fold, VAL_FILE_NAME))
+            for fold in self.folds
+        }
+        self.cache = {}
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.cache[entry['key']] = entry['metrics']
+
+    def _key(self, cfg, fold):
+        fold_name = os.path.basename(os.path.normpath(fold))
+        return (f'{fold_name}:{self.fold_hashes[fold]}:{self.graph_hash}:{cfg_hash(cfg)}:'
+                f'{self.sample}:{self.seed}:{self.k}:{self.min_rating}')
+
+    def evaluate(self, cfg):
+        """
+        :param cfg: config dict for spreader
+        :return: dict with the mean and variance across folds of each metric, and the metrics of each fold under 'folds'
+        """
+        missing = [fold for fold in self.folds if self._key(cfg, fold) not in self.cache]
+        args = (self.sample, self.seed, self.k, self.min_rating)
+        if self.n_workers > 1 and len(missing) > 1:
+            futures = {fold: self.pool().submit(evaluate_fold, cfg, fold, *args) for fold in missing}
+            results = {fold: future.result() for fold, future in futures.items()}
+        else:
+            if missing and self.spreader is None:
+                self.spreader = Spreader.from_snapshot(self.snapshot_file, self.ttl_file)
+            results = {fold: evaluate_fold(cfg, fold, *args, spreader=self.spreader) for fold in missing}
+        for fold, metrics in results.items():
+            self._store(self._key(cfg, fold), metrics)
+
+        fold_metrics = {fold: self.cache[self._key(cfg, fold)] for fold in self.folds}
+        summary = {}
+        for metric in METRICS:
+            values = [metrics[metric] for metrics in fold_metrics.values()]
+            summary[f'{metric}_mean'] = float(np.mean(values))
+            summary[f'{metric}_var'] = float(np.var(values))
+        summary['folds'] = fold_metrics
+        return summary
+
+    def _store(self, key, metrics):
+        self.cache[key] = metrics
+        if self.cache_file:
+            with open(self.cache_file, 'a') as f:
+                f.write(json.dumps({'key': key, 'metrics': metrics}) + '\n')
+
+    def objective(self, cfg):
+        """
+        Cross validates a config, logs it to MLFlow and returns 1-mean NDCG. Use this for fmin.
+        :param cfg: config dict for spreader
+        :return: 1-NDCG for minimisation function
+        """
+        summary = self.evaluate(cfg)
+        with mlflow.start_run():
+            log_cfg(cfg)
+            mlflow.log_metrics({key: value for key, value in summary.items() if key != 'folds'})
+            mlflow.log_param('folds', len(self.folds))
+        return 1 - summary['ndcg_mean']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune spreading activation hyperparameters with cross validation')
+    parser.add_argument('--max-evals', type=int, default=100, help='number of configs to try')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, one per fold if not set')
+    parser.add_argument('--sample', type=int, default=None, help='number of random users per fold, all if not set')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the user sample')
+    parser.add_argument('--cache', default=None, help='json lines file to keep fold results in across runs')
+    args = parser.parse_args()
+
+    Spreader.from_snapshot(SNAPSHOT_FILE, TTL_FILE)  # Make sure the snapshot is up to date before workers load it
+    with CrossValidator(n_workers=args.workers, sample=args.sample, seed=args.seed, cache_file=args.cache) as cv:
+        print(f'Cross validating on {len(cv.folds)} folds: {", ".join(cv.folds)}')
+        best = fmin(fn=cv.objective, space=CFG_SPACE, algo=tpe.suggest, max_evals=args.max_evals)
+    print(best)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+
+from spreading_activation import Spreader, WorkerPool, worker, DEFAULT_CFG, SNAPSHOT_FILE, TTL_FILE
+
+MIN_RATING = 3  # Movies rated at least this are activated, and count as relevant in validation
+K = 20
+PRUNE_AFTER = 50  # When pruning, running NDCG is checked after every this many users
+
+
+class UserRatings:
+    """
+    Ratings of a data split grouped by user once, so that getting the ratings of a user does not filter the whole split
+    """
+
+    def __init__(self, split):
+        """
+        :param split: DataFrame with UID, OID and rating columns
+        """
+        split = split.sort_values('UID', kind='stable')
+        uids, starts = np.unique(split.UID.values, return_index=True)
+        self.uids = uids
+        self._oids = dict(zip(uids.tolist(), np.split(split.OID.values, starts[1:])))
+        self._ratings = dict(zip(uids.tolist(), np.split(split.rating.values, starts[1:])))
+
+    def __contains__(self, uid):
+        return uid in self._oids
+
+    def __len__(self):
+        return len(self.uids)
+
+    def ratings(self, uid):
+        """
+        :param uid: user id
+        :return: array of rated movie OIDs, array of their ratings (empty if the user has no ratings)
+        """
+        if uid not in self._oids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return self._oids[uid], self._ratings[uid]
+
+    def movies(self, uid, min_rating=None):
+        """
+        :param uid: user id
+        :param min_rating: if given, only movies rated at least this are returned
+        :return: array of OIDs of movies rated by the user
+        """
+        oids, ratings = self.ratings(uid)
+        return oids if min_rating is None else oids[ratings >= min_rating]
+
+
+def read_ratings(filename):
+    """
+    Reads a data split, the csv can be with or without the UID,OID,rating header
+    :param filename: csv file of the split
+    :return: DataFrame with UID, OID and rating columns
+    """
+    with open(filename, 'r') as f:
+        has_header = 'UID' in f.readline()
+    return pd.read_csv(filename, header=0 if has_header else None, names=['UID', 'OID', 'rating'])
+
+
+def select_users(ratings, sample=None, seed=0):
+    """
+    :param ratings: UserRatings to select from
+    :param sample: number of users to select at random, all users if None
+    :param seed: seed for the random selection
+    :return: list of selected user ids
+    """
+    if sample is None or sample >= len(ratings):
+        return ratings.uids.tolist()
+    return sorted(np.random.default_rng(seed).choice(ratings.uids, size=sample, replace=False).tolist())
+
+
+def ndcg(recs, oids, ratings, k=K):
+    """
+    :param recs: recommended OIDs in order
+    :param oids: OIDs of movies rated by the user in validation
+    :param ratings: ratings of oids
+    :param k: how many recommendations are scored
+    :return: NDCG@k, 0 if the user has no validation ratings
+    """
+    if len(oids) == 0:
+        return 0
+    dcg_penalty = 1 / np.log2(np.arange(k) + 2)
+    ideal = np.sort(ratings)[::-1][:k]
+    idcg = (ideal * dcg_penalty[:len(ideal)]).sum()
+    user_ratings = dict(zip(oids.tolist(), ratings.tolist()))
+    recs_relevant = np.array([user_ratings.get(int(oid), 0) for oid in recs[:k]])
+    dcg = (recs_relevant * dcg_penalty[:len(recs_relevant)]).sum()
+    return dcg / idcg
+
+
+def precision(recs, relevant, k=K):
+    """
+    :param recs: recommended OIDs in order
+    :param relevant: set of relevant OIDs
+    :param k: how many recommendations are scored
+    :return: precision@k
+    """
+    return sum(int(oid) in relevant for oid in recs[:k]) / k
+
+
+def recall(recs, relevant, k=K):
+    """
+    :param recs: recommended OIDs in order
+    :param relevant: set of relevant OIDs
+    :param k: how many recommendations are scored
+    :return: recall@k, 0 if there are no relevant movies
+    """
+    if not relevant:
+        return 0
+    return sum(int(oid) in relevant for oid in recs[:k]) / len(relevant)
+
+
+def evaluate_users(spreader, cfg, train, val, uids, k=K, min_rating=MIN_RATING, trace=False):
+    """
+    Recommends to each user and scores the recommendations
+    :param spreader: Spreader to recommend with
+    :param cfg: config dict for spreader
+    :param train: UserRatings to initially activate with
+    :param val: UserRatings to evaluate with
+    :param uids: list of user ids
+    :param k: how many recs to get
+    :param min_rating: movies rated at least this are activated, and are relevant in validation
+    :param trace: also add the SpreadTrace.summary() of each user's spread under 'trace', needs a Spreader
+    :return: list of per-user result dicts
+    """
+    spreader.update_cfg(cfg)
+    results = []
+    for uid in uids:
+        time_started = timer()
+        movies = train.movies(uid, min_rating)
+        spread_trace = spreader.spread(movies, trace=True) if trace else spreader.spread(movies)
+        recs = [rec[1] for rec in spreader.get_top_k_as_list(k)]
+        seconds = timer() - time_started
+        val_oids, val_ratings = val.ratings(uid)
+        relevant = set(val_oids[val_ratings >= min_rating].tolist())
+        results.append({
+            'uid': uid,
+            'ndcg': ndcg(recs, val_oids, val_ratings, k),
+            'precision': precision(recs, relevant, k),
+            'recall': recall(recs, relevant, k),
+            'recs': recs,
+            'seconds': seconds,
+            'nodes_touched': spreader.nodes_touched(),
+        })
+        if trace:
+            results[-1]['trace'] = spread_trace.summary()
+    return results
+
+
+def _evaluate_chunk(cfg, uids, k, min_rating, trace):
+    return evaluate_users(worker['spreader'], cfg, worker['train'], worker['val'], uids, k, min_rating, trace)
+
+
+class Evaluator(WorkerPool):
+    """
+    Evaluates spreader configs on the users of a data split, optionally spreading for different users in worker
+    processes.
+    The worker pool is started on first use and kept for later evaluations, each worker loads the graph snapshot once.
+    """
+
+    def __init__(self, train, val, spreader=None, n_workers=1, k=K, min_rating=MIN_RATING,
+                 snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE, trace=False):
+        """
+        :param train: UserRatings to initially activate with
+        :param val: UserRatings to evaluate with
+        :param spreader: Spreader used when n_workers is 1, loaded from snapshot_file if None
+        :param n_workers: number of worker processes
+        :param k: how many recs to get per user
+        :param min_rating: movies rated at least this are activated, and are relevant in validation
+        :param trace: trace the spreads and add the mean and max of every trace counter to the metrics
+        """
+        super().__init__(n_workers, snapshot_file, ttl_file, worker_state={'train': train, 'val': val})
+        self.train = train
+        self.val = val
+        self.spreader = spreader
+        self.k = k
+        self.min_rating = min_rating
+        self.trace = trace
+
+    def evaluate(self, cfg, uids=None, prune_below=None, prune_after=PRUNE_AFTER):
+        """
+        :param cfg: config dict for spreader
+        :param uids: list of user ids to evaluate, all users with validation ratings if None
+        :param prune_below: if given, users are evaluated prune_after at a time and the evaluation stops early
+                            when the mean NDCG of the users so far is below this
+        :param prune_after: how many users are evaluated between the checks of prune_below
+        :return: dict of average metrics, catalogue coverage, timing, whether the evaluation was stopped early
+                 under 'pruned' and the per-user results under 'users'
+        """
+        if uids is None:
+            uids = self.val.uids.tolist()
+        time_started = timer()
+        step = prune_after if prune_below is not None else max(len(uids), 1)
+        results = []
+        pruned = False
+        for start in range(0, len(uids), step):
+            results.extend(self._evaluate_users(cfg, uids[start:start + step]))
+            if prune_below is None or len(results) == len(uids):
+                continue
+            if np.mean([result['ndcg'] for result in results]) < prune_below:
+                pruned = True
+                break
+        summary = summarise(results, self.catalogue_size(), timer() - time_started)
+        summary['pruned'] = pruned
+        return summary
+
+    def _evaluate_users(self, cfg, uids):
+        """
+        :return: per-user results from evaluate_users(), in the worker pool if there is more than one worker
+        """
+        if self.n_workers > 1:
+            chunks = np.array_split(np.array(uids), min(len(uids), self.n_workers * 4))
+            futures = [
+                self.pool().submit(_evaluate_chunk, cfg, chunk.tolist(), self.k, self.min_rating, self.trace)
+                for chunk in chunks
+            ]
+            results = [result for future in futures for result in future.result()]
+        else:
+            if self.spreader is None:
+                self.spreader = Spreader.from_snapshot(self.snapshot_file, self.ttl_file)
+            results = evaluate_users(
+                self.spreader, cfg, self.train, self.val, uids, self.k, self.min_rating, self.trace,
+            )
+        return results
+
+    def catalogue_size(self):
+        if self.spreader is None:
+            self.spreader = Spreader.from_snapshot(self.snapshot_file, self.ttl_file)
+        return len(self.spreader.movies)
+
+
+def summarise(results, catalogue_size, seconds):
+    """
+    :param results: per-user results from evaluate_users()
+    :param catalogue_size: number of movies that can be recommended
+    :param seconds: wall time of the evaluation
+    :return: dict of average metrics, catalogue coverage, timing, trace counters if the users were traced
+             and the per-user results under 'users'
+    """
+    user_seconds = np.array([result['seconds'] for result in results])
+    nodes_touched = np.array([result['nodes_touched'] for result in results])
+    recommended = {oid for result in results for oid in result['recs']}
+    summary = {
+        'ndcg': float(np.mean([result['ndcg'] for result in results])) if results else 0,
+        'precision': float(np.mean([result['precision'] for result in results])) if results else 0,
+        'recall': float(np.mean([result['recall'] for result in results])) if results else 0,
+        'coverage': len(recommended) / catalogue_size if catalogue_size else 0,
+        'n_users': len(results),
+        'seconds': seconds,
+        'user_seconds_mean': float(user_seconds.mean()) if results else 0,
+        'user_seconds_p95': float(np.percentile(user_seconds, 95)) if results else 0,
+        'user_seconds_max': float(user_seconds.max()) if results else 0,
+        'nodes_touched_mean': float(nodes_touched.mean()) if results else 0,
+        'nodes_touched_max': int(nodes_touched.max()) if results else 0,
+    }
+    traced = [result['trace'] for result in results if 'trace' in result]
+    for key in (traced[0] if traced else {}):  # Mean and max of every trace counter over the users
+        values = [trace.get(key, 0) for trace in traced]
+        summary[f'trace_{key}_mean'] = float(np.mean(values))
+        summary[f'trace_{key}_max'] = float(np.max(values))
+    summary['users'] = results
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the default spreader config on a data fold')
+    parser.add_argument('--train', default='fold_1/t.csv', help='csv of ratings to activate with')
+    parser.add_argument('--val', default='fold_1/val.csv', help='csv of ratings to evaluate with')
+    parser.add_argument('--sample', type=int, default=None, help='number of random users to evaluate, all if not set')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the user sample')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-k', type=int, default=K, help='how many recs to get per user')
+    args = parser.parse_args()
+
+    train = UserRatings(read_ratings(args.train))
+    val = UserRatings(read_ratings(args.val))
+    with Evaluator(train, val, n_workers=args.workers, k=args.k) as evaluator:
+        metrics = evaluator.evaluate(DEFAULT_CFG, select_users(val, args.sample, args.seed))
+    for key, value in metrics.items():
+        if key != 'users':
+            print(f'{key}:\t{value}')
+
+
+if __name__ == "__main__":
+    main()
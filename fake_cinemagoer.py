@@ -0,0 +1,100 @@
+import argparse
+import random
+import re
+import tempfile
+import threading
+import zlib
+from collections import Counter
+
+from imdb.Movie import Movie
+from imdb.Person import Person
+
+from preprocess import FetchCache, fetch_movies
+
+GENRES = ['Action', 'Comedy', 'Drama', 'Horror', 'Romance', 'Sci-Fi', 'Thriller', 'War']
+
+
+class FakeCinemagoer:
+    """
+    Offline stand-in for the Cinemagoer client, to run fetch_movies() without IMDB.
+    Every title is found and gets made up metadata, the same title always gives the same movie.
+    """
+    lock = threading.Lock()
+
+    def __init__(self, fail=None, calls=None, n_people=500):
+        """
+        :param fail: dict of title to the number of searches for it that raise ConnectionError before one succeeds,
+        counted down by all clients given the same dict
+        :param calls: Counter of the searches made for each title, shared by the clients given the same Counter
+        :param n_people: number of made up people the cast and directors are taken from
+        """
+        self.fail = fail if fail is not None else {}
+        self.calls = calls if calls is not None else Counter()
+        self.n_people = n_people
+        self.titles = {}
+
+    def search_movie(self, title):
+        with self.lock:
+            self.calls[title] += 1
+            if self.fail.get(title, 0) > 0:
+                self.fail[title] -= 1
+                raise ConnectionError(f'Failing search for "{title}"')
+        movie_id = f'{zlib.crc32(title.encode()) % 10 ** 7:07d}'
+        self.titles[movie_id] = title
+        return [Movie(movieID=movie_id, data={'title': title})]
+
+    def get_movie(self, movie_id):
+        title = self.titles[movie_id]
+        rng = random.Random(movie_id)
+        year = re.search(r'\((\d{4})\)', title)
+        people = [
+            Person(personID=f'{i:07d}', data={'name': f'Person {i}'}) for i in rng.sample(range(self.n_people), 6)
+        ]
+        return Movie(movieID=movie_id, data={
+            'title': title,
+            'year': int(year.group(1)) if year else 1900 + rng.randrange(120),
+            'cast': people[:5],
+            'director': people[5:],
+            'genres': rng.sample(GENRES, 2),
+        })
+
+
+def check_fetch(cache_dir, retries=2):
+    """
+    Checks fetch_movies() offline: failed searches are retried, movies failing after all retries are skipped,
+    and a rerun fetches only the skipped movies, taking the others from the cache
+    :param cache_dir: empty directory to use as the fetch cache
+    :param retries: retries of fetch_movies()
+    """
+    movies = [('1', 'Toy Story (1995)'), ('2', 'Jumanji (1995)'), ('3', 'Heat (1995)')]
+    fail = {'Jumanji (1995)': retries, 'Heat (1995)': retries + 1}  # Jumanji succeeds on its last retry
+    calls = Counter()
+
+    def client_factory():
+        return FakeCinemagoer(fail, calls)
+
+    args = dict(cache_dir=cache_dir, max_rate=None, retries=retries, backoff=0, client_factory=client_factory)
+    fetched = fetch_movies(movies, log=False, **args)
+    assert set(fetched) == {1, 2}, f'First run fetched {sorted(fetched)}'
+    assert calls == {'Toy Story (1995)': 1, 'Jumanji (1995)': retries + 1, 'Heat (1995)': retries + 1}, calls
+    cache = FetchCache(cache_dir)
+    assert 1 in cache and 2 in cache and 3 not in cache, 'Only fetched movies should be cached'
+
+    calls.clear()
+    fetched = fetch_movies(movies, log=False, **args)
+    assert set(fetched) == {1, 2, 3}, f'Rerun fetched {sorted(fetched)}'
+    assert calls == {'Heat (1995)': 1}, f'Rerun should only search the skipped movie, searched {dict(calls)}'
+    assert fetched[1]['title'] == 'Toy Story (1995)' and fetched[3]['year'] == 1995
+    print('Fetch check passed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check fetching movies offline with the Cinemagoer stand-in')
+    parser.add_argument('--retries', type=int, default=2, help='retries of fetch_movies()')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        check_fetch(cache_dir, args.retries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+from rdflib import URIRef
+
+from compiled_graph import MovieIndex, NodeUris, SnapshotError, load_arrays, save_arrays
+from evaluation import UserRatings, read_ratings, select_users, MIN_RATING
+from spreading_activation import (
+    Spreader, INIT_ACTIVATION, DEFAULT_CFG, SNAPSHOT_FILE, TTL_FILE, cfg_hash, top_k_indices,
+)
+
+INDEX_MAGIC = b'SAINDEX\x00'
+INDEX_VERSION = 1
+INDEX_FILE = './movielens/ml-1m/imdb-1m_2.contributions'
+TOP_N = 200
+
+
+class ContributionIndex:
+    """
+    For each movie, the top_n largest activations a spread from that movie alone gives to other movies.
+    Recommendations are then the sum of the vectors of the seed movies, which only approximates Spreader.spread().
+    A single movie rarely gets a node over activation_threshold on its own, so the vectors are built with a lower
+    threshold (0 by default) and nodes that would not reach the threshold in the exact spread still contribute.
+    Activation is also clamped to 1 per movie sum rather than per node, and activations outside the top_n are dropped.
+    Use measure_error() to check how far the approximation is from the exact spread for a config.
+    """
+
+    def __init__(self, movie_uris, movie_oids, offsets, targets, values, cfg_key=None, spread_steps=2):
+        """
+        :param movie_uris: URIs of all movies, position in the list is the movie position
+        :param movie_oids: movielens OIDs of the movies
+        :param offsets: int64 array of length n_movies + 1 with the start of each movie's vector
+        :param targets: int32 array of movie positions receiving the activation
+        :param values: float32 array of the activation received
+        :param cfg_key: cfg_hash() of the config the index was built with
+        :param spread_steps: spread steps the index was built with
+        """
+        self.movie_uris = movie_uris
+        self.movie_oids = movie_oids
+        self.offsets = offsets
+        self.targets = targets
+        self.values = values
+        self.cfg_key = cfg_key
+        self.spread_steps = spread_steps
+        self.movies = MovieIndex(movie_oids.tolist(), list(movie_uris))  # A movie has a position per OID
+
+    @classmethod
+    def build(cls, spreader, top_n=TOP_N, spread_steps=2, build_threshold=0, log=True):
+        """
+        Spreads from every movie of the graph separately with the spreader's current config
+        :param spreader: Spreader with the config to precompute
+        :param top_n: how many of the most activated movies to keep per movie
+        :param spread_steps: how many steps of spreading activation to perform
+        :param build_threshold: activation_threshold used for the single movie spreads
+        :param log: print progress
+        :return: ContributionIndex
+        """
+        compiled = spreader.compiled
+        n_movies = len(compiled.movie_nodes)
+        offsets = np.zeros(n_movies + 1, dtype=np.int64)
+        targets, values = [], []
+        time_started = timer()
+        activation_threshold = spreader.activation_threshold
+        spreader.activation_threshold = build_threshold
+        try:
+            for position, oid in enumerate(compiled.movie_oids):
+                spreader.spread([oid], spread_steps)
+                movie_act = spreader.activation[compiled.movie_nodes]
+                candidates = movie_act > 0
+                candidates[compiled.movie_nodes == compiled.movie_nodes[position]] = False
+                top = top_k_indices(movie_act, candidates, top_n)
+                targets.append(top.astype(np.int32))
+                values.append(movie_act[top].astype(np.float32))
+                offsets[position + 1] = offsets[position] + len(top)
+                if log and (position + 1) % 500 == 0:
+                    print(f'Precomputed {position + 1}/{n_movies} movies, time taken {round(timer() - time_started)}s')
+        finally:
+            spreader.activation_threshold = activation_threshold
+        return cls(
+            NodeUris.from_list([compiled.node_uris[node] for node in compiled.movie_nodes]),
+            np.array(compiled.movie_oids, dtype=np.int64), offsets,
+            np.concatenate(targets) if targets else np.zeros(0, dtype=np.int32),
+            np.concatenate(values) if values else np.zeros(0, dtype=np.float32),
+            cfg_key=spreader.cfg_key, spread_steps=spread_steps,
+        )
+
+    def save(self, filename):
+        save_arrays(filename, {
+            'movie_uri_data': self.movie_uris.data,
+            'movie_uri_offsets': self.movie_uris.offsets,
+            'movie_oids': self.movie_oids,
+            'offsets': self.offsets,
+            'targets': self.targets,
+            'values': self.values,
+        }, {'cfg_key': self.cfg_key, 'spread_steps': self.spread_steps}, magic=INDEX_MAGIC, version=INDEX_VERSION)
+
+    @classmethod
+    def load(cls, filename, cfg=None):
+        """
+        Memory-maps an index written by save()
+        :param filename: index file
+        :param cfg: if given, the index must have been built with this config
+        :return: ContributionIndex
+        """
+        header, arrays = load_arrays(filename, magic=INDEX_MAGIC, version=INDEX_VERSION)
+        if cfg is not None and header['cfg_key'] != cfg_hash(cfg):
+            raise SnapshotError(f'index "{filename}" was built with a different config')
+        return cls(
+            NodeUris(arrays['movie_uri_data'], arrays['movie_uri_offsets']), arrays['movie_oids'],
+            arrays['offsets'], arrays['targets'], arrays['values'],
+            cfg_key=header['cfg_key'], spread_steps=header['spread_steps'],
+        )
+
+    def activation(self, movies_to_activate):
+        """
+        :param movies_to_activate: list of movielens OIDs of movies to activate initially
+        :return: approximate activation of every movie, list of positions of the seed movies
+        """
+        seeds = self.movies.positions(movies_to_activate)
+        movie_act = np.zeros(len(self.movie_oids))
+        for movie in self.movies.lookup(movies_to_activate)[0]:
+            position = self.movies.node_to_positions[movie][0]  # Every OID of a movie has the same contributions
+            start, end = self.offsets[position], self.offsets[position + 1]
+            np.add.at(movie_act, self.targets[start:end], self.values[start:end])
+        np.minimum(movie_act, 1, out=movie_act)
+        movie_act[seeds] = INIT_ACTIVATION
+        return movie_act, seeds
+
+    def recommend(self, movies_to_activate, k=20, exclude=None):
+        """
+        :param movies_to_activate: list of movielens OIDs of movies to activate initially
+        :param k: How many recommended items to get
+        :param exclude: movielens OIDs of other movies not to recommend
+        :return: list of recommended items (movie uri, ml OID, activation)
+        """
+        movie_act, seeds = self.activation(movies_to_activate)
+        excluded = np.zeros(len(movie_act), dtype=bool)
+        excluded[seeds] = True
+        if exclude is not None:
+            excluded[self.movies.positions(exclude)] = True
+        return [
+            (URIRef(self.movie_uris[i]), int(self.movie_oids[i]), float(movie_act[i]))
+            for i in top_k_indices(movie_act, ~excluded, k)
+        ]
+
+
+def measure_error(spreader, index, seed_sets, k=20):
+    """
+    Compares the index with exact spreading on the spreader, which must have the config the index was built with.
+    Seed sets whose exact top k are all unactivated movies are left out, their top k is an arbitrary pick of ties.
+    :param spreader: Spreader to spread exactly with
+    :param index: ContributionIndex to compare
+    :param seed_sets: list of lists of movielens OIDs to activate initially
+    :param k: How many recommended items to compare
+    :return: dict with the mean and max absolute activation error over all movies, the mean top-k overlap
+             and the number of seed sets compared
+    """
+    mean_errors, max_errors, overlaps = [], [], []
+    for seeds in seed_sets:
+        spreader.spread(seeds, index.spread_steps)
+        exact = spreader.get_top_k_as_list(k)
+        if not any(rec[2] > 0 for rec in exact):
+            continue
+        exact_act = spreader.activation[spreader.compiled.movie_nodes]
+        approx_act, _ = index.activation(seeds)
+        approx = index.recommend(seeds, k)
+        errors = np.abs(exact_act - approx_act)
+        mean_errors.append(errors.mean())
+        max_errors.append(errors.max())
+        overlaps.append(len({rec[1] for rec in exact} & {rec[1] for rec in approx}) / k)
+    if not overlaps:
+        return {'mean_abs_error': 0.0, 'max_abs_error': 0.0, f'top_{k}_overlap': 0.0, 'seed_sets': 0}
+    return {
+        'mean_abs_error': float(np.mean(mean_errors)),
+        'max_abs_error': float(np.max(max_errors)),
+        f'top_{k}_overlap': float(np.mean(overlaps)),
+        'seed_sets': len(overlaps),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute per-movie activation contributions for the default config')
+    parser.add_argument('--out', default=INDEX_FILE, help='index file to write')
+    parser.add_argument('--top-n', type=int, default=TOP_N, help='how many activated movies to keep per movie')
+    parser.add_argument('--error-users', type=int, default=200,
+                        help='number of random users of --train to measure the approximation error on, 0 to skip')
+    parser.add_argument('--train', default='fold_1/t.csv', help='csv of ratings to take the error users from')
+    args = parser.parse_args()
+
+    spreader = Spreader.from_snapshot(SNAPSHOT_FILE, TTL_FILE)
+    spreader.update_cfg(DEFAULT_CFG)
+    index = ContributionIndex.build(spreader, top_n=args.top_n)
+    index.save(args.out)
+    print(f'Index of {len(index.targets)} contributions saved to {args.out}')
+    if args.error_users:
+        train = UserRatings(read_ratings(args.train))
+        seed_sets = [train.movies(uid, MIN_RATING) for uid in select_users(train, args.error_users)]
+        for key, value in measure_error(spreader, index, seed_sets).items():
+            print(f'{key}:\t{value}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
+import argparse
+import os
 import os.path
+import pickle
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote_plus
 
 from imdb import Cinemagoer
 from rdflib import Graph, URIRef, Literal, RDF
 from timeit import default_timer as timer
 
+from compiled_graph import (
+    CompiledGraph, GraphBuilder, SnapshotError, file_hash, remove_movies, triple_movies, triple_oids,
+)
+
 ML_VERSION = '1m'
 ML_LOCATION = f'./movielens/ml-{ML_VERSION}/movies.dat'
 TTL_FILE = f'./movielens/ml-{ML_VERSION}/imdb-{ML_VERSION}_3.ttl'
+FETCH_CACHE_DIR = f'./movielens/ml-{ML_VERSION}/fetched'  # Checkpoint of fetched movies
+FETCH_WORKERS = 8
+FETCH_MAX_RATE = 10  # Requests per second
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 2  # Seconds before the first retry
 
 
 def read_movielens(path, limit=sys.maxsize):
@@ -28,39 +43,269 @@ def read_movielens(path, limit=sys.maxsize):
     return found_movies
 
 
-def fetch_movies(movies, log=True):
-    """Searches for movie using Cinemagoer, saves found movie into list"""
-    ia = Cinemagoer()
+class RateLimiter:
+    """Spaces out calls across threads so that at most max_rate calls start per second"""
+
+    def __init__(self, max_rate):
+        self.interval = 1 / max_rate if max_rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def with_retries(fn, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, limiter=None):
+    """
+    Calls fn, retrying with exponential backoff if it raises
+    :param fn: function without arguments
+    :param retries: how many times to retry after the first attempt
+    :param backoff: seconds to wait before the first retry, doubled for every next one
+    :param limiter: RateLimiter to wait for before every attempt
+    :return: result of fn
+    """
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.wait()
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f'\t{e.__class__.__name__}: {e}, retrying in {delay}s')
+            time.sleep(delay)
+
+
+def fetch_movie(ia, movie, limiter=None, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """
+    Searches for movie using Cinemagoer and fetches its complete info
+    :param ia: Cinemagoer client
+    :param movie: tuple (ml_id, ml_title)
+    :return: cinemagoer movie object, None if it was not found
+    """
+    def call(fn, *args):
+        return with_retries(lambda: fn(*args), retries=retries, backoff=backoff, limiter=limiter)
+
+    searched_movie = call(ia.search_movie, movie[1])  # search_movie returns an incomplete dict, this is to get id
+    if len(searched_movie) == 0:  # Cinemagoer didn't find a match
+        name_without_pars = movie[1][:movie[1].find('(')]  # Often does find if parentheses are removed
+        print(f'\tCould find movie \"{movie[1]}\" in IMDB, looking for \"{name_without_pars}\"')
+        searched_movie = call(ia.search_movie, name_without_pars)  # trying again
+        if len(searched_movie) == 0:
+            print(f'\tCould not find movie \"{name_without_pars}\" in IMDB, skipped')
+            return None
+        print(f"\tAdded \"{name_without_pars}\"")
+    return call(ia.get_movie, searched_movie[0].movieID)  # must use get_movie to get complete info
+
+
+class FetchCache:
+    """
+    On-disk checkpoint of fetched movies, one pickle file per movie, so an interrupted fetch can resume.
+    Movies that were not found are stored too, so they are not searched again.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, ml_id):
+        return os.path.join(self.cache_dir, f'{ml_id}.pkl')
+
+    def __contains__(self, ml_id):
+        return os.path.isfile(self._path(ml_id))
+
+    def get(self, ml_id):
+        """
+        :return: cached cinemagoer movie object, None if the movie was not found in IMDB
+        """
+        with open(self._path(ml_id), 'rb') as f:
+            return pickle.load(f)
+
+    def movies(self, movies):
+        """
+        Reads cached movies one at a time
+        :param movies: list of tuples (ml_id, ml_title)
+        :return: generator of (ml_id, cinemagoer movie object) of the cached movies that were found in IMDB
+        """
+        for movie in movies:
+            ml_id = int(movie[0])
+            if ml_id in self:
+                cached_movie = self.get(ml_id)
+                if cached_movie is not None:
+                    yield ml_id, cached_movie
+
+    def put(self, ml_id, movie):
+        tmp_path = f'{self._path(ml_id)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(movie, f)
+        os.replace(tmp_path, self._path(ml_id))
+
+    def remove(self, ml_id):
+        """
+        Drops a movie from the cache, so it is fetched again
+        """
+        if ml_id in self:
+            os.remove(self._path(ml_id))
+
+
+def fetch_movies(movies, log=True, cache_dir=FETCH_CACHE_DIR, n_workers=FETCH_WORKERS, max_rate=FETCH_MAX_RATE,
+                 retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, client_factory=Cinemagoer, keep=True):
+    """
+    Searches for movies using Cinemagoer in a pool of threads, saves found movies into dict.
+    Every fetched movie is written to the cache directory, movies already there are not fetched again.
+    Movies that still fail after all retries are skipped and will be fetched again by the next run.
+    :param movies: list of tuples (ml_id, ml_title)
+    :param log: log progress
+    :param cache_dir: checkpoint directory, None to not cache
+    :param n_workers: number of fetching threads, this is the most requests that run at once
+    :param max_rate: most requests started per second across all threads, None for no limit
+    :param retries: how many times a failed request is retried
+    :param backoff: seconds to wait before the first retry, doubled for every next one
+    :param client_factory: creates a client with search_movie and get_movie, one is created per thread
+    :param keep: if False, the movies are only written to the cache and not returned, see FetchCache.movies()
+    :return: dict of ml_id to cinemagoer movie object
+    """
+    cache = FetchCache(cache_dir) if cache_dir else None
+    limiter = RateLimiter(max_rate)
+    local = threading.local()
     fetched_movies = {}
+    to_fetch = []
+    for movie in movies:
+        if cache is None or int(movie[0]) not in cache:
+            to_fetch.append(movie)
+        elif keep:
+            cached_movie = cache.get(int(movie[0]))
+            if cached_movie is not None:
+                fetched_movies[int(movie[0])] = cached_movie
+    if log and cache is not None:
+        print(f'{len(movies) - len(to_fetch)} movies loaded from cache, fetching {len(to_fetch)}')
 
-    logging_frequency = len(movies) / 50  # For logging progress
+    def fetch(movie):
+        if not hasattr(local, 'ia'):
+            local.ia = client_factory()
+        fetched_movie = fetch_movie(local.ia, movie, limiter=limiter, retries=retries, backoff=backoff)
+        if cache is not None:
+            cache.put(int(movie[0]), fetched_movie)
+        return fetched_movie
+
+    logging_frequency = len(to_fetch) / 50  # For logging progress
     last_logged = 0
     time_started = timer()
-
-    for i, movie in enumerate(movies):
-        searched_movie = ia.search_movie(movie[1])  # search_movie returns an incomplete dict, this is to get id
-        if len(searched_movie) == 0:  # Cinemagoer didn't find a match
-            name_without_pars = movie[1][:movie[1].find('(')]  # Often does find if parentheses are removed
-            print(f'\tCould find movie \"{movie[1]}\" in IMDB, looking for \"{name_without_pars}\"')
-            searched_movie = ia.search_movie(name_without_pars)  # trying again
-            if len(searched_movie) == 0:
-                print(f'\tCould not find movie \"{name_without_pars}\" in IMDB, skipped')
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(fetch, movie): movie for movie in to_fetch}
+        for i, future in enumerate(as_completed(futures)):
+            movie = futures[future]
+            try:
+                fetched_movie = future.result()
+            except Exception as e:
+                print(f"Exception during fetching movie {movie[1]}, skipping")
+                print(e)
                 continue
-            print(f"\tAdded \"{name_without_pars}\"")
+            if fetched_movie is not None and keep:
+                fetched_movies[int(movie[0])] = fetched_movie
+
+            if log and i >= last_logged + logging_frequency:  # Log fetching progress
+                last_logged += logging_frequency
+                time_taken = round((timer() - time_started) / 60)
+                print(f"Fetching movies {round(100 * last_logged / len(to_fetch))}% done, time taken {time_taken}min.")
+    return fetched_movies
+
+
+CONCEPTS = [
+    {'key': 'director', 'predicate': 'https://schema.org/Director', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'composer', 'predicate': 'https://schema.org/Composer', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'writer', 'predicate': 'https://schema.org/Writer', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'producer', 'predicate': 'https://schema.org/Producer', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'editor', 'predicate': 'https://schema.org/Editor', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'cast', 'predicate': 'https://schema.org/Actor', 'uri_prefix': 'https://www.imdb.com/name/nm',
+     'obj_type': 'https://schema.org/Person'},
+    {'key': 'genres', 'predicate': 'https://schema.org/Genre', 'uri_prefix': 'https://www.imdb.com/genre/',
+     'obj_type': 'https://schema.org/Genre'},
+    {'key': 'languages', 'predicate': 'https://schema.org/inLanguage', 'uri_prefix': 'https://www.imdb.com/langs/',
+     'obj_type': 'https://schema.org/Language'},
+    {'key': 'countries', 'predicate': 'https://schema.org/countryOfOrigin',
+     'uri_prefix': 'https://www.imdb.com/countries/', 'obj_type': 'https://schema.org/Country'},
+]  # Metadata of a movie that becomes graph edges
+ML_OID = URIRef('https://example.org/ml-OID')
+
+
+def movie_triples(ml_oid, movie):
+    """
+    Creates the RDF triples of one movie using its IMDB metadata,
+    together with the type and name of every node it links to
+    :param ml_oid: movielens OID of the movie
+    :param movie: cinemagoer movie object
+    :return: list of triples, empty if the movie is missing its title or year
+    """
+    if not movie['title']:
+        print('\tMovie missing title, skipping')
+        return []
+    if not movie['year']:
+        print(f'\tMissing year for movie {movie["title"]}')
+        return []
+    current_uri = URIRef(f'https://www.imdb.com/title/tt{movie.movieID}')
+    triples = [  # Basic movie predicates
+        (current_uri, RDF.type, URIRef('https://schema.org/Movie')),
+        (current_uri, URIRef('https://schema.org/Name'), Literal(movie['title'])),
+        (current_uri, URIRef('https://schema.org/datePublished'), Literal(movie['year'])),
+        (current_uri, ML_OID, Literal(ml_oid)),
+    ]
+    for concept in CONCEPTS:  # Create graph edges
+        if concept['key'] in movie.keys():
+            for item in movie[concept['key']]:
+                if not item:
+                    continue  # Sometimes there was a None
+                uri = concept['uri_prefix'] + quote_plus(try_get_id(item))
+                triples += named_triples(concept['obj_type'], try_get_name(item), uri)
+                triples.append((current_uri, URIRef(concept['predicate']), URIRef(uri)))
+    decade, decade_uri = get_decade(movie['year'])  # Decade aggregation edge
+    triples += named_triples('https://example.org/Decade', decade, decade_uri)
+    triples.append((current_uri, URIRef('https://example.org/fromDecade'), URIRef(decade_uri)))
+    return triples
+
 
+def stream_triples(movies, seen=None):
+    """
+    Creates the RDF triples of all movies one movie at a time, each triple only once.
+    Written triples are remembered only by their hash in seen, not as triples or in an rdflib Graph,
+    so seen still grows with the graph, but by one int per movie and per triple of a shared node (people, genres, ...).
+    :param movies: dict of ml_id to cinemagoer movie object, or any iterable of (ml_id, movie) pairs
+    :param seen: set of hashes of already created triples, shared between calls to continue a graph
+    :return: generator of triples
+    """
+    if seen is None:
+        seen = set()
+    for ml_oid, movie in movies.items() if isinstance(movies, dict) else movies:
         try:
-            fetched_movie = ia.get_movie(searched_movie[0].movieID)  # must use get_movie to get complete info
+            triples = movie_triples(ml_oid, movie)
         except Exception as e:
-            print("Exception during fetching movie, skipping")
-            print(e)
+            print(f"Exception {e} occurred while serialising {movie['title']}, skipping movie")
             continue
-        fetched_movies[int(movie[0])] = fetched_movie
-
-        if log and i >= last_logged + logging_frequency:  # Log fetching progress
-            last_logged += logging_frequency
-            time_taken = round((timer() - time_started) / 60)
-            print(f"Fetching movies {round(100 * last_logged / len(movies))}% done, time taken {time_taken}min.")
-    return fetched_movies
+        if not triples:
+            continue
+        movie_uri = triples[0][0]
+        if hash(movie_uri) in seen:  # Same IMDB movie as an earlier movielens movie, only the OID is new
+            yield next(triple for triple in triples if triple[1] == ML_OID)
+            continue
+        seen.add(hash(movie_uri))
+        for triple in dict.fromkeys(triples):  # Duplicates within a movie are dropped in order
+            if triple[0] != movie_uri:
+                triple_hash = hash(triple)
+                if triple_hash in seen:
+                    continue
+                seen.add(triple_hash)
+            yield triple
 
 
 def rdf_serialise(movies):
@@ -70,75 +315,149 @@ def rdf_serialise(movies):
     :return: Graph serialisation
     """
     g = Graph()
-    concepts_to_add = [
-        {'key': 'director', 'predicate': 'https://schema.org/Director', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'composer', 'predicate': 'https://schema.org/Composer', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'writer', 'predicate': 'https://schema.org/Writer', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'producer', 'predicate': 'https://schema.org/Producer', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'editor', 'predicate': 'https://schema.org/Editor', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'cast', 'predicate': 'https://schema.org/Actor', 'uri_prefix': 'https://www.imdb.com/name/nm',
-         'obj_type': 'https://schema.org/Person'},
-        {'key': 'genres', 'predicate': 'https://schema.org/Genre', 'uri_prefix': 'https://www.imdb.com/genre/',
-         'obj_type': 'https://schema.org/Genre'},
-        {'key': 'languages', 'predicate': 'https://schema.org/inLanguage', 'uri_prefix': 'https://www.imdb.com/langs/',
-         'obj_type': 'https://schema.org/Language'},
-        {'key': 'countries', 'predicate': 'https://schema.org/countryOfOrigin',
-         'uri_prefix': 'https://www.imdb.com/countries/', 'obj_type': 'https://schema.org/Country'},
-    ]
-    for ml_oid, movie in movies.items():
-        try:
-            if not movie['title']:
-                print('\tMovie missing title, skipping')
-                continue
-            if not movie['year']:
-                print(f'\tMissing year for movie {movie["title"]}')
-                continue
-            current_uri = f'https://www.imdb.com/title/tt{movie.movieID}'
-            basic_movie_info = [
-                {'predicate': RDF.type, 'object': URIRef('https://schema.org/Movie')},
-                {'predicate': URIRef('https://schema.org/Name'), 'object': Literal(movie['title'])},
-                {'predicate': URIRef('https://schema.org/datePublished'), 'object': Literal(movie['year'])},
-                {'predicate': URIRef('https://example.org/ml-OID'), 'object': Literal(ml_oid)},
-            ]
-            for info in basic_movie_info:
-                g.add((  # Create basic movie predicates
-                    URIRef(current_uri),
-                    info['predicate'],
-                    info['object']
-                ))
-            for concept in concepts_to_add:  # Create graph edges
-                if concept['key'] in movie.keys():
-                    for item in movie[concept['key']]:
-                        if not item:
-                            continue  # Sometimes there was a None
-                        uri = concept['uri_prefix'] + quote_plus(try_get_id(item))
-                        rdf_insert_named(g, concept['obj_type'], try_get_name(item), uri)
-                        g.add((
-                            URIRef(current_uri),
-                            URIRef(concept['predicate']),
-                            URIRef(uri)
-                        ))
-            if movie['year']:  # Decade aggregation edge
-                g.add((
-                    URIRef(current_uri),
-                    URIRef('https://example.org/fromDecade'),
-                    URIRef(get_decade(g, movie['year']))
-                ))
-        except Exception as e:
-            print(f"Exception {e} occurred while serialising {movie['title']}, skipping movie")
-            continue
+    for triple in stream_triples(movies):
+        g.add(triple)
     return g
 
 
-def get_decade(graph, year):
+def write_ntriples(movies, filename, snapshot_file=None):
+    """
+    Writes the graph of movies as N-Triples one movie at a time, without building it in memory.
+    N-Triples are also valid Turtle, so the file can be read the same as one from save_graph().
+    :param movies: dict of ml_id to cinemagoer movie object, or any iterable of (ml_id, movie) pairs
+    :param filename: file to write the graph to
+    :param snapshot_file: if given, the compiled graph is also saved there as a spreader snapshot
+    :return: number of triples written
+    """
+    builder = GraphBuilder() if snapshot_file else None
+    tmp_filename = f'{filename}.tmp'
+    n_triples = 0
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        for triple in stream_triples(movies):
+            f.write(ntriple(triple))
+            if builder is not None:
+                builder.add(*triple)
+            n_triples += 1
+    os.replace(tmp_filename, filename)
+    if builder is not None:
+        builder.build().save(snapshot_file, source_hash=file_hash(filename))
+    return n_triples
+
+
+def ntriple(triple):
+    """
+    :return: the triple as a line of N-Triples
+    """
+    subj, pred, obj = triple
+    return f'{subj.n3()} {pred.n3()} {obj.n3()} .\n'
+
+
+def graph_movies(ttl_file):
+    """
+    Finds the movies in a graph file and their movielens OIDs.
+    An N-Triples file is only scanned for its ml-OID lines, any other Turtle file has to be parsed.
+    :param ttl_file: graph file
+    :return: list of tuples (movie URI, ml OID)
+    """
+    marker = f' {ML_OID.n3()} '
+    oid_lines = []
+    with open(ttl_file, encoding='utf-8') as f:
+        for line in f:
+            if marker in line:
+                oid_lines.append(line)
+            elif line.strip() and not line.startswith(('<', '_:', '#')):  # Not N-Triples
+                graph = Graph()
+                graph.parse(ttl_file)
+                break
+        else:
+            graph = Graph()
+            graph.parse(data=''.join(oid_lines), format='nt')
+    return [(str(movie), int(oid.toPython())) for movie, oid in graph.subject_objects(ML_OID)]
+
+
+def apply_delta(ttl_file, add_movies=(), remove_oids=(), snapshot_file=None, **fetch_args):
+    """
+    Adds and removes movies in an existing graph file without fetching and serialising all movies again.
+    Only the added movies are fetched, always from IMDB, their cached copies are dropped first.
+    If nothing is removed or replaced, their triples are appended to the file as N-Triples,
+    otherwise the file is parsed and written again without the removed movies (and nodes linked only to them).
+    A snapshot of the graph before the change is updated with the delta instead of compiled again.
+    :param ttl_file: existing graph file
+    :param add_movies: list of tuples (ml_id, ml_title) of movies to add, movies already in the graph are replaced
+    :param remove_oids: movielens OIDs of movies to remove
+    :param snapshot_file: spreader snapshot to update, if given
+    :param fetch_args: arguments for fetch_movies()
+    :return: triples of the added movies
+    """
+    cache_dir = fetch_args.pop('cache_dir', FETCH_CACHE_DIR)
+    source_hash = file_hash(ttl_file)
+    compiled = None
+    if snapshot_file and os.path.isfile(snapshot_file):
+        try:
+            compiled = CompiledGraph.load(snapshot_file, source_hash=source_hash)
+        except SnapshotError as e:
+            print(f'Cannot update snapshot: {e}')
+    cache = FetchCache(cache_dir)
+    for movie in add_movies:  # Re-added movies are fetched again, not taken from an old fetch
+        cache.remove(int(movie[0]))
+    fetch_movies(add_movies, cache_dir=cache_dir, keep=False, **fetch_args)
+    add_triples = list(stream_triples(cache.movies(add_movies)))
+    added_oids = triple_oids(add_triples)
+    added_movies = triple_movies(add_triples)
+    # The OIDs, or the IMDB movies under another OID, can already be in the graph
+    if compiled is not None:
+        movie_nodes = compiled.movie_nodes.tolist()
+        movie_oids = [(compiled.node_uris[node], oid) for node, oid in zip(movie_nodes, compiled.movie_oids.tolist())]
+    elif add_triples:
+        movie_oids = graph_movies(ttl_file)
+    else:
+        movie_oids = []
+    replaced = {uri for uri, oid in movie_oids if uri in added_movies or oid in added_oids}
+
+    if remove_oids or replaced:
+        print(f'Removing {len(remove_oids)} and replacing {len(replaced)} movies, parsing "{ttl_file}"...')
+        graph = Graph()
+        graph.parse(ttl_file)
+        removed = remove_movies(graph, [*remove_oids, *added_oids], replace=added_movies)
+        for triple in add_triples:
+            graph.add(triple)
+        tmp_filename = f'{ttl_file}.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            for triple in graph:
+                f.write(ntriple(triple))
+        os.replace(tmp_filename, ttl_file)
+        print(f'Removed {len(set(removed) - set(added_oids))} movies, added {len(added_oids)}')
+    else:
+        graph = None
+        with open(ttl_file, 'rb') as f:  # The appended triples must start on a new line
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - 1, 0))
+            new_line = size > 0 and f.read(1) != b'\n'
+        with open(ttl_file, 'a', encoding='utf-8') as f:
+            if new_line:
+                f.write('\n')
+            for triple in add_triples:
+                f.write(ntriple(triple))
+        print(f'Appended {len(add_triples)} triples of {len(added_oids)} movies to "{ttl_file}"')
+
+    if compiled is not None:
+        compiled = compiled.apply_delta(add_triples, remove_oids)
+    elif snapshot_file and graph is not None:
+        compiled = CompiledGraph.from_rdf(graph)
+    if compiled is not None:
+        compiled.save(snapshot_file, source_hash=file_hash(ttl_file))
+        print(f'Snapshot "{snapshot_file}" updated')
+    elif snapshot_file:
+        print(f'Snapshot "{snapshot_file}" is out of date, Spreader.from_snapshot() will rebuild it')
+    return add_triples
+
+
+def get_decade(year):
+    """
+    :return: decade of the year, URI of the decade
+    """
     decade = year - year % 10
-    decade_uri = f'https://www.imdb.com/decades/'
-    return rdf_insert_named(graph, 'https://example.org/Decade', decade, f'{decade_uri}{decade}')
+    return decade, f'https://www.imdb.com/decades/{decade}'
 
 
 def try_get_id(obj):
@@ -159,10 +478,11 @@ def try_get_name(obj):
     return str(obj)
 
 
-def rdf_insert_named(graph, obj_type, name, uri):
-    graph.add((URIRef(uri), RDF.type, URIRef(obj_type)))
-    graph.add((URIRef(uri), URIRef('https://schema.org/Name'), Literal(name)))
-    return uri
+def named_triples(obj_type, name, uri):
+    return [
+        (URIRef(uri), RDF.type, URIRef(obj_type)),
+        (URIRef(uri), URIRef('https://schema.org/Name'), Literal(name)),
+    ]
 
 
 def save_graph(graph, filename):
@@ -171,27 +491,41 @@ def save_graph(graph, filename):
 
 
 def main():
-    if len(sys.argv) > 1:
-        ml_location = sys.argv[1]
-    else:
-        ml_location = ML_LOCATION
-    if len(sys.argv) > 1:
-        ttl_file = sys.argv[0]
-    else:
-        ttl_file = TTL_FILE
+    parser = argparse.ArgumentParser(description='Create the movie graph from movielens and IMDB')
+    parser.add_argument('ttl_file', nargs='?', default=TTL_FILE, help='file to save the graph to')
+    parser.add_argument('ml_location', nargs='?', default=ML_LOCATION, help='movielens movies.dat file')
+    parser.add_argument('--snapshot', default=None, help='also save the compiled graph as a spreader snapshot here')
+    parser.add_argument('--workers', type=int, default=FETCH_WORKERS, help='number of fetching threads')
+    parser.add_argument('--max-rate', type=float, default=FETCH_MAX_RATE, help='most IMDB requests per second')
+    parser.add_argument('--add', type=int, nargs='+', default=[], metavar='ML_ID',
+                        help='add (or replace) these movielens movies in the existing graph')
+    parser.add_argument('--remove', type=int, nargs='+', default=[], metavar='ML_ID',
+                        help='remove these movielens movies from the existing graph')
+    args = parser.parse_args()
 
-    if os.path.isfile(ttl_file):
-        print(f'TTL file already exists at {ttl_file}, to run this script, change path or delete the file')
+    if args.add or args.remove:
+        if not os.path.isfile(args.ttl_file):
+            print(f'TTL file not found at {args.ttl_file}, run without --add and --remove to create it')
+            exit()
+        add_ids = set(args.add)
+        add_movies = [movie for movie in read_movielens(args.ml_location) if int(movie[0]) in add_ids]
+        missing = add_ids - {int(movie[0]) for movie in add_movies}
+        if missing:
+            print(f'Movies {sorted(missing)} not found in "{args.ml_location}", skipped')
+        apply_delta(args.ttl_file, add_movies, args.remove, args.snapshot, n_workers=args.workers,
+                    max_rate=args.max_rate)
+        return
+    if os.path.isfile(args.ttl_file):
+        print(f'TTL file already exists at {args.ttl_file}, to run this script, change path or delete the file')
         exit()
-    print(f'Reading movielens from "{ml_location}"...')
-    ml_movies = read_movielens(ml_location)
+    print(f'Reading movielens from "{args.ml_location}"...')
+    ml_movies = read_movielens(args.ml_location)
     print(f'Read {len(ml_movies)} movies.')
     print('Fetching movie info using Cinemagoer...')
-    found_movies = fetch_movies(ml_movies)
-    print(f'IMDB info loaded, serialising to RDF...')
-    graph = rdf_serialise(found_movies)
-    print(f'RDF serialisation complete, saving to {ttl_file}...')
-    save_graph(graph, ttl_file)
+    fetch_movies(ml_movies, n_workers=args.workers, max_rate=args.max_rate, keep=False)
+    print(f'IMDB info loaded, serialising to RDF and saving to {args.ttl_file}...')
+    n_triples = write_ntriples(FetchCache(FETCH_CACHE_DIR).movies(ml_movies), args.ttl_file, args.snapshot)
+    print(f'RDF serialisation of {n_triples} triples complete')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,403 @@
+import argparse
+import asyncio
+import json
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from http import HTTPStatus
+from timeit import default_timer as timer
+
+import numpy as np
+
+from spreading_activation import (
+    Spreader, ResultCache, DEFAULT_CFG, SNAPSHOT_FILE, TTL_FILE, cfg_hash, init_worker, worker,
+)
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # Seconds
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+MAX_K = 1000
+MAX_SPREAD_STEPS = 10  # Activation rarely gets past a few steps, more only keeps a worker busy
+MAX_BODY = 1 << 20  # Bytes
+
+
+def validate_cfg(cfg):
+    """
+    Checks a config sent in a request before it reaches the workers
+    :param cfg: config dict for spreader, as sent by the client
+    :raises ValueError: if a key is unknown or a value is not a number of the right range
+    """
+    def number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+    for key, value in cfg.items():
+        if key == 'edge_weights':
+            if not isinstance(value, dict) or not all(
+                    isinstance(pred, str) and number(weight) and weight >= 0 for pred, weight in value.items()):
+                raise ValueError('"edge_weights" must map predicate URIs to non-negative numbers')
+        elif key in ('activation_threshold', 'decay_factor', 'degree_norm'):
+            if not number(value) or value < 0:
+                raise ValueError(f'"{key}" must be a non-negative number')
+        elif key in ('max_degree', 'max_fanout'):
+            if value is not None and (not number(value) or value < 0):
+                raise ValueError(f'"{key}" must be a non-negative number or null')
+        else:
+            raise ValueError(f'unknown config key "{key}"')
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, each bucket counts the values up to its upper bound
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)  # Last bucket is everything above
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :return: upper bound of the bucket containing the q quantile, None if nothing was observed
+        """
+        if not self.count:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return self.buckets[bucket] if bucket < len(self.buckets) else float('inf')
+
+    def to_dict(self):
+        return {
+            'buckets': {str(bound): int(count) for bound, count in zip([*self.buckets, 'inf'], self.counts)},
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class PendingRequest:
+    def __init__(self, oids, k, cfg, spread_steps, exclude, future):
+        self.oids = oids
+        self.k = k
+        self.cfg = cfg
+        self.spread_steps = spread_steps
+        self.exclude = exclude
+        self.future = future
+        self.batch_key = (cfg_hash(cfg), spread_steps)  # Only requests with the same key can be spread together
+        self.received = timer()
+
+
+def _ready():
+    pass
+
+
+def _recommend_batch(cfg, oid_lists, k, spread_steps, exclude):
+    spreader = worker['spreader']
+    spreader.update_cfg(cfg)
+    time_started = timer()
+    recs = spreader.spread_batch(oid_lists, k, spread_steps, exclude=exclude)
+    recs = [[(str(uri), oid, act) for uri, oid, act in user_recs] for user_recs in recs]
+    return recs, timer() - time_started
+
+
+class RecommendationService:
+    """
+    HTTP service recommending from a warm graph. Concurrent requests are collected into batches that are spread
+    together with Spreader.spread_batch() in worker processes, so the event loop only parses requests and never spreads.
+    Every worker loads the graph snapshot once at start and at most one batch runs per worker, so while all workers
+    are busy, new requests wait in the queue and go out as one larger batch.
+    Requests are batched only with requests of the same config and spread steps.
+    """
+
+    def __init__(self, snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE, n_workers=2, max_batch=64, max_delay=0.005,
+                 cache_entries=0):
+        """
+        :param n_workers: number of worker processes
+        :param max_batch: most requests spread at once
+        :param max_delay: seconds a batch waits for more requests once a worker is free
+        :param cache_entries: size of the result cache, 0 to not cache results
+        """
+        self.snapshot_file = snapshot_file
+        self.ttl_file = ttl_file
+        self.n_workers = n_workers
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.result_cache = ResultCache(cache_entries) if cache_entries else None
+        self.movies = None
+        self.pool = None
+        self.pending = deque()
+        self.has_pending = None
+        self.free_workers = None
+        self.tasks = set()
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.request_latency = Histogram(LATENCY_BUCKETS)
+        self.queue_latency = Histogram(LATENCY_BUCKETS)
+        self.batch_latency = Histogram(LATENCY_BUCKETS)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+
+    def start(self):
+        """
+        Loads the movie index and starts the workers, must be called from the event loop before the server starts.
+        The pool only starts its processes when tasks are submitted, and forked workers would inherit the sockets open
+        at that moment, keeping client connections open after the service closes them. So all workers are started
+        and have loaded the snapshot before this returns.
+        """
+        spreader = Spreader.from_snapshot(self.snapshot_file, self.ttl_file)  # Rebuilds the snapshot if out of date
+        self.movies = spreader.movies
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.n_workers, initializer=init_worker, initargs=(self.snapshot_file, self.ttl_file),
+        )
+        wait([self.pool.submit(_ready) for _ in range(self.n_workers)])
+        self.has_pending = asyncio.Event()
+        self.free_workers = asyncio.Semaphore(self.n_workers)
+        self._spawn(self._batch_loop())
+
+    def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)  # Keeps a reference until the task is done
+        task.add_done_callback(self.tasks.discard)
+
+    async def recommend(self, oids, k=20, cfg=None, spread_steps=2, exclude=None):
+        """
+        :param oids: list of movielens OIDs of movies to activate initially
+        :param k: How many recommended items to get
+        :param cfg: config dict for spreader, DEFAULT_CFG if None
+        :param spread_steps: how many steps of spreading activation to perform
+        :param exclude: movielens OIDs of other movies not to recommend
+        :return: list of recommended items (movie uri, ml OID, activation)
+        """
+        cfg = cfg or DEFAULT_CFG
+        key = None
+        if self.result_cache is not None:
+            key = ResultCache.key(oids, cfg_hash(cfg), k, spread_steps, exclude)
+            recs = self.result_cache.get(key)
+            if recs is not None:
+                return recs
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(PendingRequest(oids, k, cfg, spread_steps, exclude, future))
+        self.has_pending.set()
+        recs = await future
+        if key is not None:
+            self.result_cache.put(key, recs)
+        return recs
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.free_workers.acquire()
+            while not self.pending:
+                self.has_pending.clear()
+                await self.has_pending.wait()
+            deadline = loop.time() + self.max_delay
+            while len(self.pending) < self.max_batch and loop.time() < deadline:
+                self.has_pending.clear()
+                try:
+                    await asyncio.wait_for(self.has_pending.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            # Batch the oldest request with the next ones that can be spread together, keep the rest in order
+            batch_key = self.pending[0].batch_key
+            batch, rest = [], deque()
+            for request in self.pending:
+                if request.batch_key == batch_key and len(batch) < self.max_batch:
+                    batch.append(request)
+                else:
+                    rest.append(request)
+            self.pending = rest
+            self._spawn(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        time_started = timer()
+        self.in_flight += len(batch)
+        for request in batch:
+            self.queue_latency.observe(time_started - request.received)
+        self.batch_sizes.observe(len(batch))
+        try:
+            recs, seconds = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _recommend_batch, batch[0].cfg, [request.oids for request in batch],
+                max(request.k for request in batch), batch[0].spread_steps,
+                [request.exclude or [] for request in batch],
+            )
+            self.batch_latency.observe(seconds)
+            for request, user_recs in zip(batch, recs):
+                if not request.future.done():
+                    request.future.set_result(user_recs[:request.k])
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self.in_flight -= len(batch)
+            self.free_workers.release()
+
+    def metrics(self):
+        return {
+            'queue_depth': len(self.pending),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'workers': self.n_workers,
+            'request_seconds': self.request_latency.to_dict(),
+            'queue_seconds': self.queue_latency.to_dict(),
+            'batch_seconds': self.batch_latency.to_dict(),
+            'batch_size': self.batch_sizes.to_dict(),
+            'cache': self.result_cache.info() if self.result_cache is not None else None,
+        }
+
+    async def handle_recommend(self, body):
+        """
+        :param body: json object with oids (list of movielens OIDs), and optionally k, cfg, spread_steps and exclude
+        :return: json object with the recommendations and the OIDs that are not in the graph
+        """
+        request = json.loads(body or b'{}')
+        if not isinstance(request, dict):
+            raise ValueError('request must be a json object')
+        oids = request.get('oids')
+        if not isinstance(oids, list) or not all(isinstance(oid, int) for oid in oids):
+            raise ValueError('"oids" must be a list of movielens ids')
+        k = request.get('k', 20)
+        if not isinstance(k, int) or not 0 < k <= MAX_K:
+            raise ValueError(f'"k" must be an integer from 1 to {MAX_K}')
+        spread_steps = request.get('spread_steps', 2)
+        if not isinstance(spread_steps, int) or not 0 <= spread_steps <= MAX_SPREAD_STEPS:
+            raise ValueError(f'"spread_steps" must be an integer from 0 to {MAX_SPREAD_STEPS}')
+        exclude = request.get('exclude')
+        if exclude is not None and (not isinstance(exclude, list) or not all(isinstance(oid, int) for oid in exclude)):
+            raise ValueError('"exclude" must be a list of movielens ids')
+        cfg = request.get('cfg')
+        if cfg is not None:
+            if not isinstance(cfg, dict):
+                raise ValueError('"cfg" must be a json object')
+            validate_cfg(cfg)
+            cfg = {**DEFAULT_CFG, **cfg}  # Keys missing from the request keep their default
+        _, unknown = self.movies.lookup(oids)
+        recs = await self.recommend(oids, k, cfg, spread_steps, exclude)
+        return {
+            'recs': [{'uri': uri, 'oid': oid, 'activation': act} for uri, oid, act in recs],
+            'unknown': unknown,
+        }
+
+    async def route(self, method, target, body):
+        """
+        :return: HTTP status, json response
+        """
+        path = target.split('?', 1)[0]
+        if path == '/recommend':
+            if method != 'POST':
+                return HTTPStatus.METHOD_NOT_ALLOWED, {'error': 'use POST'}
+            try:
+                return HTTPStatus.OK, await self.handle_recommend(body)
+            except ValueError as e:  # json.JSONDecodeError is a ValueError too
+                return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, self.metrics()
+        if path == '/health' and method == 'GET':
+            return HTTPStatus.OK, {'status': 'ok'}
+        return HTTPStatus.NOT_FOUND, {'error': f'no route for {method} {path}'}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves HTTP/1.1 requests of one connection until the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                time_started = timer()
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, response = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'request body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    self.requests += 1
+                    try:
+                        status, response = await self.route(method, target, body)
+                    except Exception as e:
+                        status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{e.__class__.__name__}: {e}'}
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if status != HTTPStatus.OK:
+                    self.errors += 1
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(
+                    f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + payload
+                )
+                await writer.drain()
+                if target.startswith('/recommend'):
+                    self.request_latency.observe(timer() - time_started)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass  # Malformed request or client went away
+        finally:
+            writer.close()
+
+
+async def serve(host, port, **service_args):
+    service = RecommendationService(**service_args)
+    service.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f'Serving recommendations on http://{host}:{port} with {service.n_workers} workers')
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Not available on Windows, KeyboardInterrupt stops the service there
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        service.close()
+    print('Service stopped')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recommendations over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+    parser.add_argument('--max-batch', type=int, default=64, help='most requests spread at once')
+    parser.add_argument('--max-delay-ms', type=float, default=5, help='how long a batch waits for more requests')
+    parser.add_argument('--cache', type=int, default=0, help='number of results to cache, 0 to not cache')
+    parser.add_argument('--snapshot', default=SNAPSHOT_FILE, help='graph snapshot the workers load')
+    parser.add_argument('--ttl', default=TTL_FILE, help='graph file the snapshot is checked against')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(
+            args.host, args.port, snapshot_file=args.snapshot, ttl_file=args.ttl, n_workers=args.workers,
+            max_batch=args.max_batch, max_delay=args.max_delay_ms / 1000, cache_entries=args.cache,
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
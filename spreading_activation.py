@@ -1,15 +1,27 @@
+import hashlib
+import heapq
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from os import path
+from timeit import default_timer as timer
 
-from rdflib import Graph, URIRef, Literal
+import numpy as np
+from rdflib import Graph, URIRef
 from rdflib.plugins.sparql import prepareQuery
+from scipy import sparse
+
+from compiled_graph import (
+    CompiledGraph, MovieIndex, SnapshotError, file_hash, remove_movies, triple_movies, triple_oids,
+)
 
 ML_VERSION = '1m'
 TTL_FILE = f'./movielens/ml-{ML_VERSION}/imdb-{ML_VERSION}_2.ttl'
+SNAPSHOT_FILE = f'./movielens/ml-{ML_VERSION}/imdb-{ML_VERSION}_2.snapshot'
 MV_URI_PREFIX = 'https://www.imdb.com/title/tt'
 
 INIT_ACTIVATION = 1  # Activation given to initial set of nodes
 
-HAS_ACT_QUERY = prepareQuery('SELECT ?act WHERE {?node <https://example.org/hasActivation> ?act}')
 TRIPLES_QUERY = prepareQuery('SELECT ?p ?target WHERE {{ ?node ?p ?target } UNION {?target ?p ?node}}')
 DEFAULT_CFG = {
         'activation_threshold': 0.31649221592381765,
@@ -28,6 +40,15 @@ DEFAULT_CFG = {
     }
 
 
+def cfg_hash(cfg):
+    """
+    :param cfg: spreader config dict
+    :return: hash of the config that is the same for equal configs regardless of key order or number types
+    """
+    canonical = json.dumps(cfg, sort_keys=True, default=float)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
 def parse_graph(ttl_file=TTL_FILE):
     """
     Reads a TTL graph from the disc
@@ -43,7 +64,154 @@ def parse_graph(ttl_file=TTL_FILE):
     return g
 
 
-class Spreader:
+def top_k_indices(values, candidates, k):
+    """
+    Partial selection of the k largest values without sorting all of them.
+    Ties are broken by the lower index, so the result is the same as taking the first k of a stable descending sort.
+    :param values: array of values
+    :param candidates: boolean array of values that can be selected
+    :param k: how many indices to select
+    :return: indices of the selected values in descending order of value
+    """
+    indices = np.flatnonzero(candidates)
+    if k <= 0:
+        return indices[:0]
+    if k < len(indices):
+        selected = values[indices]
+        kth = np.partition(selected, len(selected) - k)[len(selected) - k]
+        above = indices[selected > kth]
+        indices = np.concatenate([above, indices[selected == kth][:k - len(above)]])
+    return indices[np.lexsort((indices, -values[indices]))]
+
+
+class ResultCache:
+    """
+    Least recently used cache of recommendations, keyed by the seed movies, the config and the request parameters
+    """
+
+    def __init__(self, max_entries=1024):
+        """
+        :param max_entries: how many results to keep, least recently used ones are evicted first
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(oids, cfg_key, k, spread_steps, exclude=None):
+        """
+        :return: hash of the request that does not depend on the order or duplicates of the movie ids
+        """
+        seeds = sorted({int(oid) for oid in oids})
+        excluded = sorted({int(oid) for oid in exclude}) if exclude is not None else None
+        canonical = json.dumps([seeds, cfg_key, k, spread_steps, excluded])
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: cached result or None if the key is not cached
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'max_entries': self.max_entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SpreadTrace:
+    """
+    Counters and timings of one Spreader.spread(), returned by spread(trace=True)
+    """
+
+    def __init__(self, predicates):
+        """
+        :param predicates: predicate URIs of the graph, position in the list is the edge type
+        """
+        self.predicates = list(predicates)
+        self.seeds = 0
+        self.unknown = 0
+        self.reset_seconds = 0
+        self.seed_seconds = 0
+        self.top_k_seconds = None
+        self.steps = []
+
+    def add_step(self, nodes_spread, edge_types, crossed, seconds):
+        """
+        :param nodes_spread: number of nodes spread in the step
+        :param edge_types: edge types of all edges activation was sent along
+        :param crossed: number of nodes that crossed the threshold for the first time
+        :param seconds: time the step took
+        """
+        counts = np.bincount(edge_types, minlength=len(self.predicates))
+        self.steps.append({
+            'nodes_spread': nodes_spread,
+            'edges': {pred: int(count) for pred, count in zip(self.predicates, counts) if count},
+            'edges_total': int(counts.sum()),
+            'crossed': crossed,
+            'seconds': seconds,
+        })
+
+    @property
+    def spread_seconds(self):
+        return sum(step['seconds'] for step in self.steps)
+
+    def summary(self):
+        """
+        :return: flat dict of numbers, totals over the spread and the counters of each step, e.g. to log as metrics
+        """
+        summary = {
+            'seeds': self.seeds,
+            'unknown': self.unknown,
+            'nodes_spread': sum(step['nodes_spread'] for step in self.steps),
+            'edges_traversed': sum(step['edges_total'] for step in self.steps),
+            'crossed': sum(step['crossed'] for step in self.steps),
+            'reset_seconds': self.reset_seconds,
+            'seed_seconds': self.seed_seconds,
+            'spread_seconds': self.spread_seconds,
+        }
+        if self.top_k_seconds is not None:
+            summary['top_k_seconds'] = self.top_k_seconds
+        for pred in self.predicates:
+            summary[f'edges_{pred.split("/")[-1]}'] = sum(step['edges'].get(pred, 0) for step in self.steps)
+        for i, step in enumerate(self.steps):
+            for key in ('nodes_spread', 'edges_total', 'crossed', 'seconds'):
+                summary[f'step{i + 1}_{key}'] = step[key]
+        return summary
+
+    def to_dict(self):
+        return {
+            'seeds': self.seeds,
+            'unknown': self.unknown,
+            'reset_seconds': self.reset_seconds,
+            'seed_seconds': self.seed_seconds,
+            'top_k_seconds': self.top_k_seconds,
+            'steps': self.steps,
+        }
+
+
+class SparqlSpreader:
+    """
+    Reference spreader that performs spreading activation with SPARQL queries directly on the rdflib graph.
+    Much slower than Spreader, kept for checking the compiled implementation against.
+    Activation is kept in a dict of the nodes it reached rather than in the graph, so the graph is never modified.
+    """
     def __init__(self, graph=None, ttl_file=None):
         if graph:
             self.graph = graph
@@ -51,10 +219,13 @@ class Spreader:
             self.graph = parse_graph(ttl_file=ttl_file)
         else:
             self.graph = parse_graph()
-        self.edge_weights = DEFAULT_CFG['edge_weights']
-        self.decay_factor = DEFAULT_CFG['decay_factor']
-        self.activation_threshold = DEFAULT_CFG['activation_threshold']
+        self.cfg_key = None
+        self.result_cache = None
+        self.update_cfg(DEFAULT_CFG)
         self.initial_uris = None
+        self.activation = {}  # Activation of nodes touched since the last reset, all other nodes have 0
+        self.movies = MovieIndex.from_rdf(self.graph)
+        self.unknown_oids = []
 
     def update_cfg(self, cfg):
         """
@@ -64,6 +235,63 @@ class Spreader:
         self.edge_weights = cfg['edge_weights']
         self.decay_factor = cfg['decay_factor']
         self.activation_threshold = cfg['activation_threshold']
+        # Fan-out control, the degree of a node is its number of edges with a predicate in edge_weights
+        self.max_degree = cfg.get('max_degree')  # Nodes of a higher degree receive activation but do not spread
+        self.max_fanout = cfg.get('max_fanout')  # Most edges a node spreads along, see spread_step() for which ones
+        self.degree_norm = cfg.get('degree_norm', 0)  # Activation sent is divided by degree ** degree_norm
+        self.cfg = cfg
+        cfg_key = cfg_hash(cfg)
+        if cfg_key != self.cfg_key and self.result_cache is not None:
+            self.result_cache.clear()  # Results of the old config are no longer valid
+        self.cfg_key = cfg_key
+
+    def enable_cache(self, max_entries=1024):
+        """
+        Turns on caching of recommend() results. The cache is cleared whenever the config changes.
+        :param max_entries: how many results to keep, least recently used ones are evicted first
+        """
+        self.result_cache = ResultCache(max_entries)
+
+    def disable_cache(self):
+        self.result_cache = None
+
+    def apply_delta(self, add_triples=(), remove_oids=()):
+        """
+        Adds and removes movies in place, without parsing the graph again. Activation is reset and cached results
+        are dropped.
+        :param add_triples: triples of the movies to add, as created by preprocess.stream_triples()
+        :param remove_oids: movielens OIDs of movies to remove, movies that are added again are replaced
+        """
+        add_triples = list(add_triples)
+        remove_movies(self.graph, [*remove_oids, *triple_oids(add_triples)], replace=triple_movies(add_triples))
+        for triple in add_triples:
+            self.graph.add(triple)
+        self.movies = MovieIndex.from_rdf(self.graph)
+        self.reset_activation()
+        self.initial_uris = None
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def recommend(self, movies_to_activate, k=20, spread_steps=2, exclude=None):
+        """
+        Performs spreading activation and returns top_k results, using the result cache if it is enabled.
+        A cached result is returned without spreading, so activation is then left as it was after the last spread.
+        :param movies_to_activate: list of movielens OIDs of movies to activate initially
+        :param k: How many recommended items to get
+        :param spread_steps: how many steps of spreading activation to perform
+        :param exclude: movielens OIDs of other movies not to recommend
+        :return: list of recommended items (movie uri, ml OID, activation)
+        """
+        if self.result_cache is None:
+            self.spread(movies_to_activate, spread_steps)
+            return self.get_top_k_as_list(k, exclude=exclude)
+        key = ResultCache.key(movies_to_activate, self.cfg_key, k, spread_steps, exclude)
+        recs = self.result_cache.get(key)
+        if recs is None:
+            self.spread(movies_to_activate, spread_steps)
+            recs = self.get_top_k_as_list(k, exclude=exclude)
+            self.result_cache.put(key, recs)
+        return list(recs)
 
     def spread(self, movies_to_activate, spread_steps=2):
         """
@@ -96,21 +324,28 @@ class Spreader:
             # Query finds all nodes that have outgoing or incoming edges to current node
             triples = self.graph.query(TRIPLES_QUERY, initBindings={'node': node_uri})
             nodes_to_activate = []  # List of nodes that will be sent activation
-            current_activation = 0  # This will be found and set
+            current_activation = self.activation.get(node_uri, 0)
 
-            for pred, obj in triples:  # Find which nodes to send to and find current activation
-                if str(pred) == 'https://example.org/hasActivation':
-                    current_activation = float(obj)  # Unpack Literal
-                elif pred not in already_spread and pred not in spread_next and (str(pred) in self.edge_weights):
+            for pred, obj in triples:  # Find which nodes to send to
+                if str(pred) in self.edge_weights:
                     nodes_to_activate.append((pred, obj))
             already_spread.add(node_uri)  # So as to not spread twice
+            degree = len(nodes_to_activate)
+            if self.max_degree is not None and degree > self.max_degree:
+                continue  # Hub node, spreading from it would reach too much of the graph
+            if self.max_fanout is not None and degree > self.max_fanout:
+                # Highest weighted edges first, then the ones to the most specific nodes (of the lowest degree),
+                # ties are broken by the URI so the choice does not depend on the order of the triples
+                nodes_to_activate.sort(
+                    key=lambda edge: (-self.edge_weights[str(edge[0])], self.degree(edge[1]), str(edge[1]))
+                )
+                nodes_to_activate = nodes_to_activate[:int(self.max_fanout)]
+            if self.degree_norm:
+                current_activation *= max(degree, 1) ** -self.degree_norm
 
             for pred, obj in nodes_to_activate:  # Send activation to found nodes and mark new ones for spread
                 act_to_send = self.edge_weights[str(pred)] * current_activation
-                node_act = 0  # Must iterate over Result, but there is only one item
-                for line in self.graph.query(HAS_ACT_QUERY, initBindings={'node': obj}):
-                    if line:
-                        node_act = float(line[0])  # doesn't exist if node wasn't activated already
+                node_act = self.activation.get(obj, 0)
                 new_activation = min(node_act + (act_to_send * self.decay_factor), 1)  # Max activation is 1
                 if (new_activation > self.activation_threshold) and (obj not in already_spread):
                     spread_next.append(obj)
@@ -118,73 +353,490 @@ class Spreader:
                 self.set_activation(obj, new_activation)
         return spread_next
 
+    def degree(self, node_uri):
+        """
+        :param node_uri: URIRef of a node
+        :return: number of edges of the node with a predicate in edge_weights
+        """
+        triples = self.graph.query(TRIPLES_QUERY, initBindings={'node': node_uri})
+        return sum(str(pred) in self.edge_weights for pred, _ in triples)
+
     def log_results(self, top_k=20):
         top_k = self.get_top_k(top_k)
         for movie, ml_oid, activation in top_k:
             print(f'[{str(ml_oid)}]:\t{str(movie)}: {activation}')
 
-    def get_top_k(self, k):
+    def get_top_k(self, k, exclude=None):
         """
         Returns list of most activated items that were not in the initial activation set
         :param k: How many recommended items to get
+        :param exclude: movielens OIDs of other movies not to recommend, e.g. all movies rated by the user
         :return: list of recommended items (movie uri, ml OID, activation)
         """
-        return self.graph.query(  # Query not prepared as this is not called often
-            f'''
-            SELECT ?mov ?mloid ?act
-            WHERE {{
-                ?mov a schema:Movie .
-                ?mov <https://example.org/ml-OID> ?mloid .
-                ?mov <https://example.org/hasActivation> ?act .
-                FILTER ( ?mov NOT IN ({', '.join(['<' + str(uri) + '>' for uri in self.initial_uris])}) )
-            }}
-            ORDER BY DESC(?act)
-            LIMIT {k}
-            '''
+        excluded = set(self.initial_uris)
+        if exclude is not None:
+            excluded.update(self.movies.lookup(exclude)[0])
+        candidates = (
+            (mov, oid, self.activation.get(mov, 0))
+            for oid, mov in zip(self.movies.oids, self.movies.nodes) if mov not in excluded
         )
+        return heapq.nlargest(k, candidates, key=lambda rec: rec[2])
 
-    def get_top_k_as_list(self, k):
-        return [(rec[0], rec[1], rec[2]) for rec in self.get_top_k(k)]
+    def get_top_k_as_list(self, k, exclude=None):
+        return [(rec[0], rec[1], rec[2]) for rec in self.get_top_k(k, exclude=exclude)]
 
     def initial_activation(self, uris_to_activate, reset=False):
         """
-        Set initial activation to INIT_ACTIVATION for selected movies, rest are unset
-        :param reset: if True, all non-initial nodes will be set to 0 (much slower)
+        Set initial activation to INIT_ACTIVATION for selected movies, rest are set to 0.
+        Only the nodes touched by the previous spread have to be reset, so this is always done.
+        :param reset: kept for compatibility, activation is always reset
         :param uris_to_activate: list of IMDB movie IDS to activate
-        :return: graph with activations
-        """
-        if True or reset:  # Set activation of all nodes to 0
-            self.graph.update(f'''
-            DELETE {{ ?s <https://example.org/hasActivation> ?act }}
-            INSERT {{ ?s <https://example.org/hasActivation> {Literal(0)} }}
-            WHERE {{ ?s a ?p }}            
-            ''')
+        :return: list of activated uris
+        """
+        self.reset_activation()
         for uri in uris_to_activate:
-            self.set_activation(uri, INIT_ACTIVATION)  # this is faster than a SPARQL query
+            self.set_activation(uri, INIT_ACTIVATION)
         return uris_to_activate
 
-    def ml_initial_activation(self, oids_to_activate, reset=False):
+    def reset_activation(self):
+        """
+        Sets activation of all nodes touched since the last reset back to 0
+        """
+        self.activation.clear()
+
+    def nodes_touched(self):
+        """
+        :return: number of nodes that received activation since the last reset, including the seed movies
+        """
+        return len(self.activation)
+
+    def ml_initial_activation(self, oids_to_activate, reset=False, strict=False):
         """
         Set initial activation to INIT_ACTIVATION for selected movies, rest are unset.
-        First finds uris of provided OIDs and then calls initial_activation()
-        :param reset: if True, all non-initial nodes will be set to 0 (much slower)
+        First finds uris of provided OIDs in the movie index and then calls initial_activation().
+        OIDs missing from the graph are skipped and stored in unknown_oids.
+        :param reset: kept for compatibility, activation is always reset
         :param oids_to_activate: list of movielens movie IDs to activate
-        :return: graph with activations
-        """
-        uris_to_activate = set()
-        for oid in oids_to_activate:
-            query = f'SELECT ?s WHERE {{ ?s <https://example.org/ml-OID> {oid} }}'
-            uri = None
-            for u in self.graph.query(query):
-                uri = u[0]
-            if not uri:
-                continue
-            uris_to_activate.add(uri)  # There should only be one
+        :param strict: if True, raise KeyError listing all unknown OIDs instead of skipping them
+        :return: list of activated uris
+        """
+        uris_to_activate, self.unknown_oids = self.movies.lookup(oids_to_activate)
+        if strict and self.unknown_oids:
+            raise KeyError(f'movies not found in graph: {self.unknown_oids}')
         return self.initial_activation(uris_to_activate, reset=reset)
 
     def set_activation(self, uri, act):
-        self.graph.set((
-            URIRef(uri),
-            URIRef('https://example.org/hasActivation'),
-            Literal(act)
-        ))
+        self.activation[URIRef(uri)] = act
+
+
+class Spreader(SparqlSpreader):
+    """
+    Spreading activation over a CompiledGraph. Gives the same results as SparqlSpreader, but the spread runs
+    on integer node ids with NumPy arrays instead of querying the triple store for every node.
+    """
+    def __init__(self, graph=None, ttl_file=None, compiled=None):
+        self.ttl_file = ttl_file or TTL_FILE
+        if compiled:
+            self.graph = None
+            self.compiled = compiled
+        else:
+            if graph:
+                self.graph = graph
+                self.ttl_file = ttl_file
+            else:
+                self.graph = parse_graph(ttl_file=self.ttl_file)
+            self.compiled = CompiledGraph.from_rdf(self.graph)
+        self.activation = np.zeros(self.compiled.n_nodes)
+        self.touched = []  # Arrays of nodes activated since the last reset
+        self.movies = self.compiled.movies
+        self.unknown_oids = []
+        self.initial_nodes = np.zeros(0, dtype=np.int32)
+        self.initial_uris = None
+        self.cfg_key = None
+        self.result_cache = None
+        self.trace = None  # SpreadTrace of the last spread, if it was traced
+        self.update_cfg(DEFAULT_CFG)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE):
+        """
+        Creates a spreader from a binary graph snapshot, skipping the TTL parsing.
+        If the snapshot is missing, of an old version or was built from a different TTL file than ttl_file,
+        the TTL file is parsed instead and the snapshot is rebuilt.
+        :param snapshot_file: snapshot location
+        :param ttl_file: source TTL file, if None or missing the snapshot is used without checking it
+        :return: Spreader
+        """
+        source_hash = file_hash(ttl_file) if ttl_file and path.isfile(ttl_file) else None
+        try:
+            compiled = CompiledGraph.load(snapshot_file, source_hash=source_hash)
+        except SnapshotError as e:
+            print(f'Cannot use snapshot: {e}, rebuilding from "{ttl_file}"')
+            spreader = cls(ttl_file=ttl_file)
+            spreader.save_snapshot(snapshot_file, source_hash=source_hash)
+            return spreader
+        print(f'Graph snapshot loaded from "{snapshot_file}"')
+        return cls(ttl_file=ttl_file, compiled=compiled)
+
+    def save_snapshot(self, snapshot_file=SNAPSHOT_FILE, source_hash=None):
+        """
+        Saves the compiled graph as a binary snapshot, see Spreader.from_snapshot()
+        :param snapshot_file: snapshot location
+        :param source_hash: hash of the source TTL file, found from the spreader's ttl_file if not given
+        """
+        if source_hash is None and self.ttl_file and path.isfile(self.ttl_file):
+            source_hash = file_hash(self.ttl_file)
+        self.compiled.save(snapshot_file, source_hash=source_hash)
+
+    def apply_delta(self, add_triples=(), remove_oids=()):
+        """
+        Adds and removes movies in place, recompiling the adjacency without parsing the TTL file.
+        Node indices change, so activation is reset and cached results are dropped.
+        The rdflib graph, if the spreader has one, is updated too.
+        :param add_triples: triples of the movies to add, as created by preprocess.stream_triples()
+        :param remove_oids: movielens OIDs of movies to remove, movies that are added again are replaced
+        """
+        add_triples = list(add_triples)
+        self.compiled = self.compiled.apply_delta(add_triples, remove_oids)
+        if self.graph is not None:
+            remove_movies(self.graph, [*remove_oids, *triple_oids(add_triples)], replace=triple_movies(add_triples))
+            for triple in add_triples:
+                self.graph.add(triple)
+        self.activation = np.zeros(self.compiled.n_nodes)
+        self.touched = []
+        self.movies = self.compiled.movies
+        self.initial_nodes = np.zeros(0, dtype=np.int32)
+        self.initial_uris = None
+        self.trace = None
+        self._compile_cfg()  # Edge types may have been added
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def update_cfg(self, cfg):
+        """
+        Set/Update the hyperparameters of the spreader.
+        :param cfg: new configuration dict
+        """
+        cfg_changed = cfg_hash(cfg) != self.cfg_key
+        super().update_cfg(cfg)
+        if cfg_changed:
+            self._compile_cfg()
+
+    def _compile_cfg(self):
+        # Edge weights indexed by edge type, predicates missing from edge_weights are not spread across
+        self.type_weights = np.array([self.edge_weights.get(pred, 0) for pred in self.compiled.predicates])
+        self.type_spreads = np.array([pred in self.edge_weights for pred in self.compiled.predicates], dtype=bool)
+        self._spread_edges = None
+        self._weight_matrix = None
+
+    def spread_edges(self):
+        """
+        Which edges activation is spread along and how much of it, from the current config with fan-out control applied,
+        built on first use
+        :return: boolean array of the edges spread along, array of the activation sent along each edge per unit
+        """
+        if self._spread_edges is None:
+            compiled = self.compiled
+            spreads = self.type_spreads[compiled.edge_types]
+            weights = self.type_weights[compiled.edge_types] * self.decay_factor
+            if self.max_degree is not None or self.max_fanout is not None or self.degree_norm:
+                sources = np.repeat(np.arange(compiled.n_nodes, dtype=np.int32), np.diff(compiled.offsets))
+                degrees = np.bincount(sources[spreads], minlength=compiled.n_nodes)
+                if self.max_degree is not None:
+                    spreads &= (degrees <= self.max_degree)[sources]
+                if self.max_fanout is not None:
+                    # Rank the edges of nodes over max_fanout by weight, then by the degree of the node they lead to
+                    # and then by its URI, same as SparqlSpreader.spread_step(), and keep the first max_fanout
+                    edges = np.flatnonzero(spreads & (degrees > self.max_fanout)[sources])
+                    targets = compiled.neighbours[edges]
+                    target_nodes, target_index = np.unique(targets, return_inverse=True)
+                    uris = [compiled.node_uris[node] for node in target_nodes]
+                    uri_ranks = np.empty(len(uris), dtype=np.int64)
+                    uri_ranks[sorted(range(len(uris)), key=uris.__getitem__)] = np.arange(len(uris))
+                    order = edges[np.lexsort((
+                        uri_ranks[target_index], degrees[targets], -self.type_weights[compiled.edge_types[edges]],
+                        sources[edges],
+                    ))]
+                    ranks = np.arange(len(order)) - np.searchsorted(sources[order], sources[order])
+                    spreads[order[ranks >= self.max_fanout]] = False
+                if self.degree_norm:
+                    weights *= np.maximum(degrees, 1).astype(float)[sources] ** -self.degree_norm
+            self._spread_edges = spreads, weights
+        return self._spread_edges
+
+    def weight_matrix(self):
+        """
+        Sparse (nodes x nodes) matrix of the activation a node sends to each of its neighbours per unit of activation,
+        built from the current config on first use
+        :return: scipy CSR matrix
+        """
+        if self._weight_matrix is None:
+            compiled = self.compiled
+            sources = np.repeat(np.arange(compiled.n_nodes, dtype=np.int32), np.diff(compiled.offsets))
+            spreads, weights = self.spread_edges()
+            self._weight_matrix = sparse.csr_matrix(  # Parallel edges between two nodes are summed
+                (weights[spreads], (sources[spreads], compiled.neighbours[spreads])),
+                shape=(compiled.n_nodes, compiled.n_nodes),
+            )
+        return self._weight_matrix
+
+    def spread(self, movies_to_activate, spread_steps=2, trace=False):
+        """
+        Resets graph activation and performs spreading activation
+        :param spread_steps: how many steps of spreading activation to perform
+        :param movies_to_activate: list of movielens OIDs of movies to activate initially
+        :param trace: count and time the work done by the spread, the following get_top_k() is timed too
+        :return: SpreadTrace of the spread if trace is True, it is also kept in Spreader.trace
+        """
+        if not self.edge_weights:
+            print("spreader used before cfg was provided")
+            return None
+        self.trace = SpreadTrace(self.compiled.predicates) if trace else None
+        if trace:
+            time_started = timer()
+            self.reset_activation()
+            self.trace.reset_seconds = timer() - time_started
+        time_started = timer()
+        nodes_to_spread = self.ml_initial_activation(movies_to_activate, reset=True)
+        already_spread = np.zeros(self.compiled.n_nodes, dtype=bool)
+        already_spread[nodes_to_spread] = True
+        self.initial_nodes = np.array(nodes_to_spread, dtype=np.int32)
+        self.initial_uris = {self.compiled.node_uri(node) for node in nodes_to_spread}
+        if trace:
+            self.trace.seed_seconds = timer() - time_started
+            self.trace.seeds = len(nodes_to_spread)
+            self.trace.unknown = len(self.unknown_oids)
+        for _ in range(spread_steps):
+            time_started = timer()
+            spread_next = self.spread_step(nodes_to_spread, already_spread)
+            if trace:  # Edges are counted after timing the step, so counting them does not slow it down
+                seconds = timer() - time_started
+                edges = self.compiled.edge_indices(nodes_to_spread)
+                edges = edges[self.spread_edges()[0][edges]]
+                self.trace.add_step(len(nodes_to_spread), self.compiled.edge_types[edges], len(spread_next), seconds)
+            nodes_to_spread = spread_next
+        return self.trace
+
+    def spread_batch(self, oid_lists, k=20, spread_steps=2, batch_size=512, exclude=None):
+        """
+        Performs spreading activation for many users at once and returns their recommendations.
+        Activation of all users is kept in a sparse (users x nodes) matrix and every step is one sparse matrix product.
+        Unlike spread(), all nodes of a step send the activation they had at the start of the step,
+        so results can differ slightly from spread() when a node receives activation in the step it spreads in.
+        :param oid_lists: list of lists of movielens OIDs to activate initially, one list per user
+        :param k: How many recommended items to get per user
+        :param spread_steps: how many steps of spreading activation to perform
+        :param batch_size: how many users to spread at once, bounds the memory used
+        :param exclude: list with the movielens OIDs of other movies not to recommend for each user
+        :return: list of recommended items (movie uri, ml OID, activation) for each user
+        """
+        top_k = []
+        for start in range(0, len(oid_lists), batch_size):
+            activation, initial = self.batch_activation(oid_lists[start:start + batch_size], spread_steps)
+            batch_exclude = exclude[start:start + batch_size] if exclude is not None else None
+            top_k.extend(self.get_top_k_batch(activation, initial, k, exclude=batch_exclude))
+        return top_k
+
+    def batch_activation(self, oid_lists, spread_steps=2):
+        """
+        Spreads activation of a batch of users, see spread_batch()
+        :param oid_lists: list of lists of movielens OIDs to activate initially, one list per user
+        :param spread_steps: how many steps of spreading activation to perform
+        :return: sparse (users x nodes) activation matrix and boolean matrix of the initially activated nodes
+        """
+        rows, cols = [], []
+        for user, oids in enumerate(oid_lists):
+            nodes, _ = self.movies.lookup(oids)
+            rows.extend([user] * len(nodes))
+            cols.extend(nodes)
+        shape = (len(oid_lists), self.compiled.n_nodes)
+        activation = sparse.csr_matrix((np.full(len(rows), float(INIT_ACTIVATION)), (rows, cols)), shape=shape)
+        initial = activation.astype(bool)
+        already_spread = initial.astype(float)
+        spreading = activation
+        weights = self.weight_matrix()
+        for _ in range(spread_steps):
+            activation = (activation + spreading @ weights).tocsr()
+            np.minimum(activation.data, 1, out=activation.data)  # Max activation is 1
+            crossed = (activation > self.activation_threshold).astype(float)
+            crossed = (crossed - crossed.multiply(already_spread)).tocsr()
+            crossed.eliminate_zeros()
+            already_spread = already_spread + crossed
+            spreading = activation.multiply(crossed).tocsr()
+        return activation, initial
+
+    def get_top_k_batch(self, activation, initial, k, exclude=None):
+        """
+        Returns list of most activated items that were not in the initial activation set for each user of a batch
+        :param activation: sparse (users x nodes) activation matrix from batch_activation()
+        :param initial: sparse (users x nodes) boolean matrix of initially activated nodes from batch_activation()
+        :param k: How many recommended items to get per user
+        :param exclude: list with the movielens OIDs of other movies not to recommend for each user
+        :return: list of recommended items (movie uri, ml OID, activation) for each user
+        """
+        movie_act = activation[:, self.compiled.movie_nodes].toarray()
+        excluded = initial[:, self.compiled.movie_nodes].toarray()
+        if exclude is not None:
+            for user, oids in enumerate(exclude):
+                excluded[user, self.movies.positions(oids)] = True
+        return [
+            self._recommendations(top_k_indices(user_act, ~user_excluded, k), user_act)
+            for user_act, user_excluded in zip(movie_act, excluded)
+        ]
+
+    def _recommendations(self, positions, movie_act):
+        """
+        :param positions: positions of the recommended movies in the movie index
+        :param movie_act: activation of all movies
+        :return: list of recommended items (movie uri, ml OID, activation)
+        """
+        compiled = self.compiled
+        return [
+            (compiled.node_uri(compiled.movie_nodes[i]), int(compiled.movie_oids[i]), float(movie_act[i]))
+            for i in positions
+        ]
+
+    def spread_step(self, nodes_to_spread, already_spread):
+        """
+        Perform on step of spreading activation. Will spread activation of all given nodes.
+        Any node that reaches activation threshold for the first time will be added to output list.
+        Nodes are spread one after another, so a node can receive activation from nodes before it in the same step.
+        :param nodes_to_spread: list of node indices to perform spread on
+        :param already_spread: boolean array of nodes that have already been activated
+        :return: nodes that have been activated above the threshold for the first time
+        """
+        spread_next = []
+        activation = self.activation
+        offsets, neighbours = self.compiled.offsets, self.compiled.neighbours
+        edge_spreads, edge_weights = self.spread_edges()
+        for node in nodes_to_spread:
+            start, end = offsets[node], offsets[node + 1]
+            spreads = edge_spreads[start:end]
+            targets = neighbours[start:end][spreads]
+            act_to_send = edge_weights[start:end][spreads] * activation[node]
+            np.add.at(activation, targets, act_to_send)
+            self.touched.append(targets)
+            activation[targets] = np.minimum(activation[targets], 1)  # Max activation is 1
+            crossed = targets[(activation[targets] > self.activation_threshold) & ~already_spread[targets]]
+            if len(crossed):
+                _, first = np.unique(crossed, return_index=True)  # Keep order of edges, but spread each node once
+                crossed = crossed[np.sort(first)]
+                already_spread[crossed] = True
+                spread_next.extend(crossed.tolist())
+        return spread_next
+
+    def get_top_k(self, k, exclude=None):
+        """
+        Returns list of most activated items that were not in the initial activation set
+        :param k: How many recommended items to get
+        :param exclude: movielens OIDs of other movies not to recommend, e.g. all movies rated by the user
+        :return: list of recommended items (movie uri, ml OID, activation)
+        """
+        time_started = timer()
+        movie_act = self.activation[self.compiled.movie_nodes]
+        excluded = np.isin(self.compiled.movie_nodes, self.initial_nodes)  # With every OID of the initial movies
+        if exclude is not None:
+            excluded[self.movies.positions(exclude)] = True
+        top_k = self._recommendations(top_k_indices(movie_act, ~excluded, k), movie_act)
+        if self.trace is not None:
+            self.trace.top_k_seconds = timer() - time_started
+        return top_k
+
+    def initial_activation(self, nodes_to_activate, reset=False):
+        """
+        Set initial activation to INIT_ACTIVATION for selected nodes, rest are set to 0
+        :param reset: kept for compatibility with SparqlSpreader, activation is always reset
+        :param nodes_to_activate: list of node indices to activate
+        :return: list of activated node indices
+        """
+        self.reset_activation()
+        self.activation[nodes_to_activate] = INIT_ACTIVATION
+        self.touched.append(np.asarray(nodes_to_activate, dtype=np.int32))
+        return nodes_to_activate
+
+    def reset_activation(self):
+        """
+        Sets activation of all nodes touched since the last reset back to 0
+        """
+        if self.touched:
+            self.activation[np.concatenate(self.touched)] = 0
+            self.touched = []
+
+    def nodes_touched(self):
+        """
+        :return: number of nodes that received activation since the last reset, including the seed movies
+        """
+        return len(np.unique(np.concatenate(self.touched))) if self.touched else 0
+
+    def ml_initial_activation(self, oids_to_activate, reset=False, strict=False):
+        """
+        Set initial activation to INIT_ACTIVATION for selected movies, rest are set to 0.
+        First finds nodes of provided OIDs in the movie index and then calls initial_activation().
+        OIDs missing from the graph are skipped and stored in unknown_oids.
+        :param reset: kept for compatibility with SparqlSpreader, activation is always reset
+        :param oids_to_activate: list of movielens movie IDs to activate
+        :param strict: if True, raise KeyError listing all unknown OIDs instead of skipping them
+        :return: list of activated node indices
+        """
+        nodes, self.unknown_oids = self.movies.lookup(oids_to_activate)
+        if strict and self.unknown_oids:
+            raise KeyError(f'movies not found in graph: {self.unknown_oids}')
+        return self.initial_activation(nodes, reset=reset)
+
+    def set_activation(self, node, act):
+        self.activation[node] = act
+        self.touched.append(np.array([node], dtype=np.int32))
+
+
+worker = {}  # Spreader of a worker process started by init_worker() under 'spreader', and any other state it was given
+
+
+def init_worker(snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE, state=None):
+    """
+    Initializer of worker processes, loads the spreader from the graph snapshot once per process into worker
+    :param snapshot_file: snapshot location, see Spreader.from_snapshot()
+    :param ttl_file: source TTL file
+    :param state: dict of anything else the worker needs (e.g. data splits), added to worker
+    """
+    worker['spreader'] = Spreader.from_snapshot(snapshot_file, ttl_file)
+    worker.update(state or {})
+
+
+class WorkerPool:
+    """
+    Base of classes that spread in worker processes started by init_worker().
+    The process pool is started on first use and kept until close(), which is also called at the end of a with block.
+    """
+
+    def __init__(self, n_workers, snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE, worker_state=None):
+        """
+        :param n_workers: number of worker processes
+        :param worker_state: dict given to init_worker() as the state of every worker
+        """
+        self.n_workers = n_workers
+        self.snapshot_file = snapshot_file
+        self.ttl_file = ttl_file
+        self.worker_state = worker_state
+        self._pool = None
+
+    def pool(self):
+        """
+        :return: ProcessPoolExecutor of the workers, started if it is not running yet
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.n_workers, initializer=init_worker,
+                initargs=(self.snapshot_file, self.ttl_file, self.worker_state),
+            )
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,9 +1,39 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 import numpy as np
 import pandas as pd
 import mlflow
-from hyperopt import hp, fmin, tpe
-
-from spreading_activation import Spreader
+from hyperopt import hp, fmin, tpe, space_eval, Domain, Trials, STATUS_OK, JOB_STATE_DONE
+from hyperopt.base import spec_from_misc
+
+import evaluation
+from evaluation import Evaluator, UserRatings, select_users, PRUNE_AFTER
+from spreading_activation import Spreader, SNAPSHOT_FILE, TTL_FILE
+
+TRAIN_FILE = 'fold_1/t.csv'
+VAL_FILE = 'fold_1/val.csv'
+PRUNE_MARGIN = 0.25  # A trial is pruned when its running NDCG is this fraction below the best NDCG so far
+LATENCY_PENALTY = 0.1  # Added to the loss for every multiple of the latency budget a trial's mean user time is over
+CFG_SPACE = {
+    'activation_threshold': hp.uniform('activation_threshold', 0.3, 0.75),  # Min activation a node needs to spread
+    'decay_factor': hp.uniform('decay_factor', 0.01, 0.2),  # What part of the activation will survive the spread
+    'edge_weights': {  # Proportional amount of activation that will flow along the edge
+        'https://example.org/fromDecade': hp.uniform('fromDecade', 0.1, 0.7),
+        'https://schema.org/Actor': hp.uniform('Actor', 0.2, 0.8),
+        'https://schema.org/Director': hp.uniform('Director', 0.1, 0.4),
+        'https://schema.org/Writer': hp.uniform('Writer', 0.3, 0.9),
+        'https://schema.org/Producer': hp.uniform('Producer', 0.1, 0.8),
+        'https://schema.org/Editor': hp.uniform('Editor', 0.15, 0.5),
+        'https://schema.org/Genre': hp.uniform('Genre', 0.1, 0.5),
+        'https://schema.org/CountryOfOrigin': hp.uniform('CountryOfOrigin', 0.15, 0.5),
+        'https://schema.org/inLanguage': hp.uniform('inLanguage', 0.4, 0.8),
+    },
+    # Fan-out control, bounds how much of the graph a hub node (genre, language, decade, ...) spreads to
+    'max_degree': hp.choice('max_degree', [None, hp.qloguniform('max_degree_value', np.log(50), np.log(5000), 50)]),
+    'max_fanout': hp.choice('max_fanout', [None, hp.qloguniform('max_fanout_value', np.log(20), np.log(2000), 10)]),
+    'degree_norm': hp.choice('degree_norm', [0, hp.uniform('degree_norm_value', 0, 1)]),
+}
 
 
 def log_cfg(cfg):
@@ -17,85 +47,204 @@ def log_cfg(cfg):
             mlflow.log_param(str(key).split('/')[-1], value)
 
 
-def rate_for_uid(split_train, split_val, uid, k=50):
+def rate_cfg(cfg, users=None, prune_below=None, prune_after=PRUNE_AFTER):
+    """
+    Recommends and rates with given config, without logging.
+    :param cfg: config dict for spreader
+    :param users: list of user ids to rate for, uids if None
+    :param prune_below: stop rating early when the running NDCG is below this, see Evaluator.evaluate()
+    :param prune_after: how many users are rated between the checks of prune_below
+    :return: dict of metrics from evaluation.Evaluator.evaluate()
+    """
+    load()
+    return evaluator.evaluate(cfg, uids if users is None else users, prune_below, prune_after)
+
+
+def prune_threshold(best_ndcg, margin=PRUNE_MARGIN):
+    """
+    :param best_ndcg: NDCG of the best trial so far, None if no trial has finished
+    :param margin: how far below the best NDCG, as a fraction of it, a trial is clearly worse
+    :return: running NDCG below which a trial is pruned, None if trials cannot be pruned yet
+    """
+    return None if best_ndcg is None else best_ndcg * (1 - margin)
+
+
+def trial_loss(metrics, latency_budget=None, penalty=LATENCY_PENALTY):
+    """
+    :param metrics: dict of metrics from rate_cfg()
+    :param latency_budget: mean seconds per user a trial may take, no penalty if None
+    :param penalty: loss added for every multiple of the budget the mean user time is over it
+    :return: 1-NDCG, plus the latency penalty if the trial went over the budget
+    """
+    loss = 1 - metrics['ndcg']
+    if latency_budget:
+        loss += penalty * max(0, metrics['user_seconds_mean'] / latency_budget - 1)
+    return loss
+
+
+def log_run(cfg, metrics, loss=None):
     """
-    Recommends to user and checks rec quality with NDCG
-    :param split_train: data split to initially activate with
-    :param split_val: data split to evaluate ndcg with
-    :param uid: user id to recommend to
-    :param k: how many recs to get
-    :return: NDCG of recommendations
+    Log one tuning trial to MLFlow as its own run, pruned trials are tagged with pruned=true
     """
-    movies_to_activate = split_train[(split_train['UID'] == uid) & (split_train['rating'] >= 3)]['OID']
-    spreader.spread(movies_to_activate)
-    top_k = spreader.get_top_k_as_list(k)
-    recs = np.array([int(rec[1]) for rec in top_k])
-    run_ndcg = ndcg(split_val, uid, recs, top_k=k)
-    return run_ndcg
+    with mlflow.start_run():
+        log_cfg(cfg)
+        mlflow.log_metrics({key: value for key, value in metrics.items() if key not in ('users', 'pruned')})
+        if loss is not None:
+            mlflow.log_metric('loss', loss)
+        mlflow.set_tag('pruned', str(metrics['pruned']).lower())
 
 
 def spread_and_rate(cfg):
     """
-    Recommends and rates with given config and returns 1-average NDCG of recommendations.
+    Recommends and rates with given config and returns 1-average NDCG of recommendations, plus the latency penalty
+    if latency_budget is set. With prune_after set, the trial stops early once it is clearly worse than the best
+    trial so far and its partial result is logged and returned.
     Use this for fmin.
     :param cfg: config dict for spreader
-    :return: 1-NDCG for minimisation function
+    :return: loss for minimisation function
     """
-    with mlflow.start_run():
-        log_cfg(cfg)
-        spreader.update_cfg(cfg)
-        total_ndcg = 0
-        # Cross validate here V
-        split_train = data
-        split_val = val_data
-        for i, uid in enumerate(uids):
-            total_ndcg += rate_for_uid(split_train, split_val, uid, 20)
-        total_ndcg /= len(uids)
-        mlflow.log_metric('ndcg', total_ndcg)
-    return 1 - total_ndcg
+    global best_ndcg
+    if prune_after:
+        metrics = rate_cfg(cfg, prune_below=prune_threshold(best_ndcg, prune_margin), prune_after=prune_after)
+    else:
+        metrics = rate_cfg(cfg)
+    loss = trial_loss(metrics, latency_budget, latency_penalty)
+    log_run(cfg, metrics, loss)
+    if not metrics['pruned'] and (best_ndcg is None or metrics['ndcg'] > best_ndcg):
+        best_ndcg = metrics['ndcg']
+    return loss
+
+
+def parallel_fmin(space, max_evals, n_workers, seed=None, trace=False, prune_after=None, prune_margin=PRUNE_MARGIN,
+                  latency_budget=None, latency_penalty=LATENCY_PENALTY):
+    """
+    Hyperopt TPE search that evaluates trials in a process pool, one trial per worker at a time.
+    Every worker loads the graph snapshot once and keeps its own spreader, so activation state is not shared.
+    A new trial is suggested as soon as any worker finishes, using all trials completed so far.
+    Trials are logged to MLFlow from this process as they finish.
+    :param space: hyperopt search space of spreader configs
+    :param max_evals: number of trials to evaluate
+    :param n_workers: number of worker processes
+    :param seed: seed for the TPE suggestions
+    :param trace: trace the spreads and log the trace counters with the trials
+    :param prune_after: if given, trials are checked against the best NDCG so far after every this many users
+                        and stopped early when clearly worse
+    :param prune_margin: how far below the best NDCG, as a fraction of it, the running NDCG of a pruned trial is
+    :param latency_budget: mean seconds per user a trial may take before its loss is penalised, see trial_loss()
+    :param latency_penalty: loss added for every multiple of the latency budget a trial is over it
+    :return: best found point of the space (same as fmin)
+    """
+    domain = Domain(rate_cfg, space)
+    trials = Trials()
+    rstate = np.random.default_rng(seed)
+    running = {}
+    best = None  # NDCG of the best trial that was not pruned
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=load, initargs=(SNAPSHOT_FILE, TTL_FILE, 1, trace),
+    ) as pool:
+        while len(trials) < max_evals or running:
+            while len(trials) < max_evals and len(running) < n_workers:  # Fill free workers with new trials
+                new_ids = trials.new_trial_ids(1)
+                trials.refresh()
+                doc = tpe.suggest(new_ids, domain, trials, rstate.integers(2 ** 31 - 1))[0]
+                cfg = space_eval(space, spec_from_misc(doc['misc']))
+                trials.insert_trial_docs([doc])
+                trials.refresh()
+                doc = trials.trials[-1]  # Trials stores a copy when bson is installed, update the stored doc
+                if prune_after:
+                    future = pool.submit(rate_cfg, cfg, uids, prune_threshold(best, prune_margin), prune_after)
+                else:
+                    future = pool.submit(rate_cfg, cfg, uids)
+                running[future] = (doc, cfg)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                doc, cfg = running.pop(future)
+                metrics = future.result()
+                loss = trial_loss(metrics, latency_budget, latency_penalty)
+                log_run(cfg, metrics, loss)
+                if not metrics['pruned'] and (best is None or metrics['ndcg'] > best):
+                    best = metrics['ndcg']
+                # The stored doc is changed in place, so the next refresh() hands the result to TPE
+                doc['state'] = JOB_STATE_DONE
+                doc['result'] = {'loss': loss, 'status': STATUS_OK}
+            trials.refresh()
+    return trials.argmin
 
 
 # uids = [30, 112, 234, 1111, 1234]  # change these maybe? idk
 uids = [31, 111, 235, 1112, 1231]  # change these maybe? idk
-spreader = Spreader()
-data = pd.read_csv('fold_1/t.csv')
-val_data = pd.read_csv('fold_1/val.csv')
+spreader = None
+data = None
+val_data = None
+evaluator = None
+prune_after = None  # Check trials of spread_and_rate against the best one after this many users each, None to not prune
+prune_margin = PRUNE_MARGIN
+latency_budget = None  # Mean seconds per user a trial of spread_and_rate may take before its loss is penalised
+latency_penalty = LATENCY_PENALTY
+best_ndcg = None  # NDCG of the best trial of spread_and_rate that was not pruned
+
+
+def load(snapshot_file=SNAPSHOT_FILE, ttl_file=TTL_FILE, n_eval_workers=1, trace=False):
+    """
+    Loads the spreader and data splits into the module globals, does nothing if they are loaded already.
+    Workers of the parallel search call this once when they start.
+    :param n_eval_workers: number of processes each evaluation spreads users in
+    :param trace: trace the spreads, the mean and max trace counters are then logged with every trial
+    """
+    global spreader, data, val_data, evaluator
+    if spreader is None:
+        spreader = Spreader.from_snapshot(snapshot_file, ttl_file)
+        data = pd.read_csv(TRAIN_FILE)
+        val_data = pd.read_csv(VAL_FILE)
+        evaluator = Evaluator(
+            UserRatings(data), UserRatings(val_data), spreader=spreader, n_workers=n_eval_workers,
+            snapshot_file=snapshot_file, ttl_file=ttl_file, trace=trace,
+        )
 
 
 def main():
-    cfg_space = {
-        'activation_threshold': hp.uniform('activation_threshold', 0.3, 0.75),  # Min activation a node needs to spread
-        'decay_factor': hp.uniform('decay_factor', 0.01, 0.2),  # What part of the activation will survive the spread
-        'edge_weights': {  # Proportional amount of activation that will flow along the edge
-            'https://example.org/fromDecade': hp.uniform('fromDecade', 0.1, 0.7),
-            'https://schema.org/Actor': hp.uniform('Actor', 0.2, 0.8),
-            'https://schema.org/Director': hp.uniform('Director', 0.1, 0.4),
-            'https://schema.org/Writer': hp.uniform('Writer', 0.3, 0.9),
-            'https://schema.org/Producer': hp.uniform('Producer', 0.1, 0.8),
-            'https://schema.org/Editor': hp.uniform('Editor', 0.15, 0.5),
-            'https://schema.org/Genre': hp.uniform('Genre', 0.1, 0.5),
-            'https://schema.org/CountryOfOrigin': hp.uniform('CountryOfOrigin', 0.15, 0.5),
-            'https://schema.org/inLanguage': hp.uniform('inLanguage', 0.4, 0.8),
-        }
-    }
-    best = fmin(fn=spread_and_rate, space=cfg_space, algo=tpe.suggest, max_evals=100)
+    parser = argparse.ArgumentParser(description='Tune spreading activation hyperparameters with hyperopt')
+    parser.add_argument('--max-evals', type=int, default=100, help='number of configs to try')
+    parser.add_argument('--workers', type=int, default=1, help='number of trials to evaluate in parallel')
+    parser.add_argument('--eval-workers', type=int, default=1,
+                        help='number of processes to spread users of a trial in, when trials are not parallel')
+    parser.add_argument('--users', type=int, default=None,
+                        help='tune on this many random validation users instead of the fixed uids, 0 for all users')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the user sample')
+    parser.add_argument('--trace', action='store_true',
+                        help='log nodes spread, edges traversed per predicate and step timings with every trial')
+    parser.add_argument('--prune-after', type=int, default=None,
+                        help='stop a trial early when its NDCG after every this many users is clearly below the best')
+    parser.add_argument('--prune-margin', type=float, default=PRUNE_MARGIN,
+                        help='fraction below the best NDCG at which a trial is clearly worse')
+    parser.add_argument('--latency-budget', type=float, default=None,
+                        help='mean seconds per user, trials over it are penalised in the loss')
+    parser.add_argument('--latency-penalty', type=float, default=LATENCY_PENALTY,
+                        help='loss added per multiple of the latency budget a trial is over it')
+    args = parser.parse_args()
+
+    global uids, prune_after, prune_margin, latency_budget, latency_penalty
+    # Also makes sure the snapshot is up to date
+    load(n_eval_workers=1 if args.workers > 1 else args.eval_workers, trace=args.trace)
+    if args.users is not None:
+        uids = select_users(evaluator.val, args.users or None, args.seed)
+    prune_after, prune_margin = args.prune_after, args.prune_margin
+    latency_budget, latency_penalty = args.latency_budget, args.latency_penalty
+
+    if args.workers > 1:
+        best = parallel_fmin(
+            CFG_SPACE, args.max_evals, args.workers, trace=args.trace, prune_after=prune_after,
+            prune_margin=prune_margin, latency_budget=latency_budget, latency_penalty=latency_penalty,
+        )
+    else:
+        best = fmin(fn=spread_and_rate, space=CFG_SPACE, algo=tpe.suggest, max_evals=args.max_evals)
+    evaluator.close()
     print(best)
 
 
 def ndcg(split_val, uid, recs, top_k=20):
-    user_data = split_val.loc[val_data.UID == uid]
-    recs = recs[:top_k]
-    dcg_penalty = 1 / np.log2(np.array(range(top_k)) + 2)
-
-    ideal = user_data.rating.sort_values(ascending=False).values[:top_k]
-    if len(ideal) > 0:
-        idcg = (ideal * dcg_penalty[:len(ideal)]).sum()
-        user_data.set_index("OID", inplace=True)
-        recs_relevant = [user_data.rating[i] if i in user_data.index else 0 for i in recs]
-        dcg = (np.array(recs_relevant) * dcg_penalty).sum()
-        return dcg / idcg
-    else:
-        return 0
+    user_data = split_val.loc[split_val.UID == uid]
+    return evaluation.ndcg(recs, user_data.OID.values, user_data.rating.values, k=top_k)
 
 
 if __name__ == "__main__":